@@ -0,0 +1,82 @@
+import random
+
+# Tooltips as lodestone writes them, the level list is split in tanks/healers/dps/crafters/gatherers
+JOB_TOOLTIPS = [
+    ['Paladin / Gladiator', 'Warrior / Marauder', 'Dark Knight', 'Gunbreaker'],
+    ['White Mage / Conjurer', 'Scholar', 'Astrologian', 'Sage'],
+    ['Monk / Pugilist', 'Dragoon / Lancer', 'Ninja / Rogue', 'Samurai', 'Reaper', 'Viper',
+     'Bard / Archer', 'Machinist', 'Dancer', 'Black Mage / Thaumaturge', 'Summoner / Arcanist',
+     'Red Mage', 'Pictomancer', 'Blue Mage (Limited Job)'],
+    ['Carpenter', 'Blacksmith', 'Armorer', 'Goldsmith', 'Leatherworker', 'Weaver', 'Alchemist', 'Culinarian'],
+    ['Miner', 'Botanist', 'Fisher'],
+]
+WORLDS = [('Cerberus', 'Chaos'), ('Omega', 'Chaos'), ('Lich', 'Light'), ('Gilgamesh', 'Aether'),
+          ('Ravana', 'Materia'), ('Tonberry', 'Elemental')]
+
+# Stands in for the navigation, gear and profile markup that surrounds the fields we care about
+FILLER = ''.join(f'<div class="character__detail__icon"><img src="https://img.finalfantasyxiv.com/{i}.png" '
+                 f'alt="" width="40" height="40"><p class="db-tooltip__item__name">Item &amp; {i}</p></div>\n'
+                 for i in range(400))
+
+
+def render_character_page(character_id: int, rng: random.Random = None) -> str:
+    """Renders a page with the same structure as https://eu.finalfantasyxiv.com/lodestone/character/{id}/"""
+    rng = rng or random.Random(character_id)
+    world, datacenter = rng.choice(WORLDS)
+    title = f'<p class="frame__chara__title">The {rng.choice(["Brave", "Warrior of Light", "Fae & Friends"])}</p>' \
+        if rng.random() < 0.6 else ''
+    free_company = f'''<div class="character__freecompany__name"><h4>
+<a href="/lodestone/freecompany/{9229001536389000000 + rng.randrange(100000)}/">Free Company {character_id % 97}</a>
+</h4></div>''' if rng.random() < 0.7 else ''
+    level_lists = ''.join(
+        '<div class="character__level__list"><ul>' +
+        ''.join(f'<li><img src="https://img.finalfantasyxiv.com/job.png" width="20" height="20" '
+                f'data-tooltip="{tooltip}" class="js__tooltip">{rng.choice(["-", rng.randint(1, 100)])}</li>'
+                for tooltip in group) +
+        '</ul></div>'
+        for group in JOB_TOOLTIPS
+    )
+    return f'''<!DOCTYPE html>
+<html lang="en-gb"><head><meta charset="utf-8"><title>Character {character_id} | FINAL FANTASY XIV</title></head>
+<body><div class="ldst__bg"><div class="ldst__contents clearfix">
+<div class="frame__chara__box">
+<p class="frame__chara__name">Chara{character_id} O&#39;Test</p>
+{title}
+<p class="frame__chara__world"><i class="xiv-lds xiv-lds-home-world js__tooltip" data-tooltip="Home World"></i>{world} [{datacenter}]</p>
+</div>
+{free_company}
+{FILLER}
+<div class="character__content selected">
+{level_lists}
+</div>
+</div></div></body></html>
+'''
+
+
+def render_member_page(fc_id: int, page: int, max_character: int = 5000) -> str:
+    """
+        Renders a page of https://eu.finalfantasyxiv.com/lodestone/freecompany/{id}/member/ with 50 members per page.
+        Members get the name and world their character page has, the free company on that page is random though.
+    """
+    rng = random.Random(fc_id)
+    members = sorted(rng.sample(range(1, max_character), min(10 + fc_id % 120, max_character - 1)))
+    pages = max((len(members) + 49) // 50, 1)
+    entries = ''.join(
+        f'''<li class="entry"><a href="/lodestone/character/{character_id}/" class="entry__bg">
+<div class="entry__flex"><div class="entry__chara__face"><img src="https://img.finalfantasyxiv.com/face.jpg" alt=""></div>
+<div class="entry__box entry__box--world"><p class="entry__name">Chara{character_id} O&#39;Test</p>
+<p class="entry__world"><i class="xiv-lds xiv-lds-home-world js__tooltip" data-tooltip="Home World"></i>{world} [{datacenter}]</p>
+<ul class="entry__freecompany__info"><li><img src="https://img.finalfantasyxiv.com/rank.png" width="16" height="16" alt="">\
+<span>{rng.choice(["Master", "Officer", "Member", "Recruit"])}</span></li></ul></div></div></a></li>
+'''
+        for character_id in members[(page - 1) * 50:page * 50]
+        for world, datacenter in [random.Random(character_id).choice(WORLDS)]
+    )
+    return f'''<!DOCTYPE html>
+<html lang="en-gb"><head><meta charset="utf-8"><title>Free Company {fc_id} | FINAL FANTASY XIV</title></head>
+<body><div class="ldst__bg"><div class="ldst__contents clearfix">
+<ul class="btn__pager"><li class="btn__pager__current">Page {page} of {pages}</li></ul>
+<ul>
+{entries}</ul>
+</div></div></body></html>
+'''
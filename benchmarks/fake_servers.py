@@ -0,0 +1,194 @@
+"""
+    Local stand-ins for lodestone and the fflogs api so the scrapers can be measured without hitting the real sites.
+
+        python benchmarks/fake_servers.py --lodestone-port 8081 --fflogs-port 8082 --throttle-rate 50
+
+    Then point the scrapers at them with LODESTONE_URL=http://127.0.0.1:8081 FFLOGS_URL=http://127.0.0.1:8082
+"""
+import argparse
+import asyncio
+import random
+import re
+import time
+import zlib
+
+from aiohttp import web
+
+from character_page import render_character_page, render_member_page
+
+# The fake fflogs ids are the lodestone ids shifted by this much
+FFLOGS_ID_OFFSET = 10_000_000
+
+
+def chance(key: str, probability: float) -> bool:
+    """Deterministic per key, the same id is always missing or always present"""
+    return zlib.crc32(key.encode()) % 10_000 < probability * 10_000
+
+
+class FakeLodestone:
+    """
+        Serves generated character pages after `latency` seconds (plus up to `jitter`).
+        A not_found share of the ids answers 404, and with throttle_rate set the requests above
+        that many per second answer 429 with a Retry-After header.
+        Free company member lists pick their members among the first `characters` ids.
+    """
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, not_found: float = 0.3,
+                 throttle_rate: float = None, retry_after: int = 1, characters: int = 5000):
+        self.latency = latency
+        self.characters = characters
+        self.jitter = jitter
+        self.not_found = not_found
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.tokens = throttle_rate or 0
+        self.updated = time.monotonic()
+        self.statuses = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/lodestone/character/{character_id}/', self.character)
+        app.router.add_get('/lodestone/freecompany/{fc_id}/member/', self.free_company_members)
+        return app
+
+    def throttled(self) -> bool:
+        if not self.throttle_rate:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.throttle_rate, self.throttle_rate)
+        self.updated = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def respond(self, status: int, **kwargs) -> web.Response:
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        return web.Response(status=status, **kwargs)
+
+    async def character(self, request):
+        if self.throttled():
+            return self.respond(429, headers={'Retry-After': str(self.retry_after)})
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+        character_id = int(request.match_info['character_id'])
+        if chance(f'lodestone{character_id}', self.not_found):
+            return self.respond(404, text='not found')
+        return self.respond(200, text=render_character_page(character_id), content_type='text/html')
+
+    async def free_company_members(self, request):
+        if self.throttled():
+            return self.respond(429, headers={'Retry-After': str(self.retry_after)})
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+        page = render_member_page(int(request.match_info['fc_id']), int(request.query.get('page', 1)), self.characters)
+        return self.respond(200, text=page, content_type='text/html')
+
+
+class FakeFFLogs:
+    """
+        Answers the token request and the graphql queries the scrapers send: aliased character fields,
+        zoneRankings with or without zoneID and rateLimitData. Every character costs cost_per_character points
+        and every zone cost_per_zone, past limit_per_hour the api answers 429 until the period ends.
+    """
+    CHARACTER = re.compile(r'(c\d+): character\(([^)]*)\)\s*\{([^{}]*)}')
+    ZONE = re.compile(r'(z\d+): zoneRankings\(zoneID: (\d+)\)')
+
+    def __init__(self, latency: float = 0.1, not_found: float = 0.1, limit_per_hour: float = 18000,
+                 cost_per_character: float = 1.0, cost_per_zone: float = 2.0, period: float = 3600):
+        self.latency = latency
+        self.not_found = not_found
+        self.limit_per_hour = limit_per_hour
+        self.cost_per_character = cost_per_character
+        self.cost_per_zone = cost_per_zone
+        self.period = period
+        self.period_start = time.monotonic()
+        self.points_spent = 0.0
+        self.statuses = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/oauth/token', self.token)
+        app.router.add_post('/api/v2/client', self.graphql)
+        return app
+
+    async def token(self, request):
+        return web.json_response({'token_type': 'Bearer', 'expires_in': 3600, 'access_token': 'fake-token'})
+
+    def rate_limit_data(self) -> dict:
+        elapsed = time.monotonic() - self.period_start
+        if elapsed >= self.period:
+            self.period_start, self.points_spent, elapsed = time.monotonic(), 0.0, 0
+        return {'limitPerHour': self.limit_per_hour, 'pointsSpentThisHour': self.points_spent,
+                'pointsResetIn': int(self.period - elapsed)}
+
+    def character(self, character_filter: str, fields: str):
+        by_id = re.search(r'id: (\d+)', character_filter)
+        by_name = re.search(r'Chara(\d+)', character_filter)
+        lodestone_id = int(by_id.group(1)) - FFLOGS_ID_OFFSET if by_id else int(by_name.group(1)) if by_name else 0
+        if not lodestone_id or chance(f'fflogs{lodestone_id}', self.not_found):
+            return None
+        character = {'name': f"Chara{lodestone_id} O'Test", 'lodestoneID': lodestone_id,
+                     'canonicalID': lodestone_id + FFLOGS_ID_OFFSET, 'hidden': False}
+        if re.search(r'zoneRankings(?!\()', fields):
+            character['zoneRankings'] = self.zone_rankings(lodestone_id, 54)
+        for alias, zone in self.ZONE.findall(fields):
+            character[alias] = self.zone_rankings(lodestone_id, int(zone))
+        return character
+
+    @staticmethod
+    def zone_rankings(lodestone_id: int, zone: int) -> dict:
+        rng = random.Random(lodestone_id * 1000 + zone)
+        return {
+            'difficulty': 101, 'zone': zone,
+            'rankings': [{
+                'encounter': {'id': zone * 100 + i, 'name': f'Boss {zone}-{i}'},
+                'rankPercent': rng.uniform(0, 100), 'medianPercent': rng.uniform(0, 100),
+                'totalKills': rng.randint(0, 50), 'spec': rng.choice(['WhiteMage', 'Paladin', 'Bard'])
+            } for i in range(4)]
+        }
+
+    async def graphql(self, request):
+        query = (await request.json())['query']
+        await asyncio.sleep(self.latency)
+        rate_limit_data = self.rate_limit_data()
+        characters = self.CHARACTER.findall(query)
+        cost = sum(self.cost_per_character + self.cost_per_zone * len(self.ZONE.findall(fields))
+                   for _, _, fields in characters) or 1
+        if self.points_spent + cost > self.limit_per_hour:
+            self.statuses[429] = self.statuses.get(429, 0) + 1
+            return web.json_response({'status': 429, 'error': 'Too many requests'}, status=429)
+        self.points_spent += cost
+        data = {}
+        if characters:
+            data['characterData'] = {alias: self.character(character_filter, fields)
+                                     for alias, character_filter, fields in characters}
+        if 'rateLimitData' in query:
+            data['rateLimitData'] = self.rate_limit_data()
+        self.statuses[200] = self.statuses.get(200, 0) + 1
+        return web.json_response({'data': data})
+
+
+async def serve(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lodestone-port', type=int, default=8081)
+    arg_parser.add_argument('--fflogs-port', type=int, default=8082)
+    arg_parser.add_argument('--latency', type=float, default=0.05)
+    arg_parser.add_argument('--not-found', type=float, default=0.3)
+    arg_parser.add_argument('--throttle-rate', type=float, default=None)
+    arg_parser.add_argument('--fflogs-limit', type=float, default=18000)
+    args = arg_parser.parse_args()
+
+    await serve(FakeLodestone(args.latency, not_found=args.not_found, throttle_rate=args.throttle_rate).app(),
+                args.lodestone_port)
+    await serve(FakeFFLogs(limit_per_hour=args.fflogs_limit).app(), args.fflogs_port)
+    print(f'lodestone on http://127.0.0.1:{args.lodestone_port}, fflogs on http://127.0.0.1:{args.fflogs_port}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
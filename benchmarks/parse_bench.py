@@ -0,0 +1,80 @@
+"""
+    Parses a corpus of lodestone character pages with every backend in lodestone_parser,
+    reports pages/sec and checks that all of them return the same dicts as the soup parser.
+
+        python benchmarks/parse_bench.py --pages saved_pages/
+        python benchmarks/parse_bench.py --synthetic 500
+
+    Saved pages are plain .html files as returned by lodestone. World normalization tables are read from
+    the metadata collection when MONGO_URI is set, otherwise world names are kept as they are.
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import lodestone_parser  # noqa: E402
+from character_page import render_character_page  # noqa: E402
+
+
+class Identity(dict):
+    def __missing__(self, key):
+        return key
+
+
+def load_tables():
+    if not os.getenv("MONGO_URI"):
+        return Identity(), Identity()
+    import utils
+    from pymongo import MongoClient
+    db = MongoClient(utils.MONGO_URI)[utils.DATABASE]
+    return lodestone_parser.world_tables(db[utils.ENDGAME_METADATA].find_one({'regions': {'$exists': True}})['regions'])
+
+
+def load_pages(args) -> list:
+    if args.pages:
+        return [path.read_text(encoding='utf-8') for path in sorted(Path(args.pages).glob('*.html'))]
+    return [render_character_page(i) for i in range(1, args.synthetic + 1)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--pages', help='directory with saved character pages')
+    arg_parser.add_argument('--synthetic', type=int, default=200, help='pages to generate when --pages is missing')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    pages = load_pages(args)
+    if not pages:
+        sys.exit('no pages to parse')
+    worlds, regions = load_tables()
+
+    results = {}
+    for name, parser_class in lodestone_parser.PARSERS.items():
+        parser = parser_class(worlds, regions)
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            parsed = [parser.parse(page) for page in pages]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = parsed
+        print(f'{name:>6}: {len(pages) / best:10.1f} pages/sec ({best * 1000 / len(pages):.3f} ms/page)')
+
+    reference = results['soup']
+    mismatches = 0
+    for name, parsed in results.items():
+        for i, (expected, got) in enumerate(zip(reference, parsed)):
+            if expected != got:
+                mismatches += 1
+                print(f'{name} differs from soup on page {i}:\n  soup: {expected}\n  {name}: {got}')
+    if mismatches:
+        sys.exit(1)
+    print(f'all backends agree on {len(pages)} pages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+    End to end throughput benchmark: runs the scraping API, LodestoneScraper and FFlogsScraper against the
+    fake servers of fake_servers.py and a local mongod, then reports requests/sec, parse time,
+    db write time and p50/p99 latencies.
+
+        MONGO_URI=mongodb://127.0.0.1:27017 python benchmarks/run_bench.py --characters 5000 --seconds 30
+
+    The database given by MONGO_DB (xivlodestonestats_bench by default) is dropped and seeded on every run.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp  # noqa: E402
+
+from character_page import WORLDS  # noqa: E402
+from fake_servers import FakeLodestone, FakeFFLogs, serve  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+
+class Recorder:
+    """Timings in seconds grouped by stage, plus the status codes seen by the scraper session"""
+    def __init__(self):
+        self.timings = {}
+        self.statuses = {}
+
+    def add(self, stage: str, elapsed: float):
+        self.timings.setdefault(stage, []).append(elapsed)
+
+    def trace_config(self, stage: str) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            kind = stage if params.url.port != int(os.environ['INDEX_API_PORT']) else 'index_api'
+            self.add(kind, time.perf_counter() - context.start)
+            key = f'{kind} {params.response.status}'
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def timed(self, stage: str, function):
+        def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def async_timed(self, stage: str, function):
+        async def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return await function(*args)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def report(self, title: str, elapsed: float):
+        print(f'\n== {title} ({elapsed:.1f}s)')
+        for stage, values in sorted(self.timings.items()):
+            print(f'{stage:>12}: {len(values):7d} calls {len(values) / elapsed:9.1f}/s  '
+                  f'total {sum(values):8.2f}s  p50 {percentile(values, 0.5) * 1000:8.2f}ms  '
+                  f'p99 {percentile(values, 0.99) * 1000:8.2f}ms')
+        for key, count in sorted(self.statuses.items()):
+            print(f'{key:>16}: {count}')
+
+
+def configure(args):
+    """Everything reads its endpoints from the environment at import time, so this runs before importing them"""
+    os.environ.setdefault('MONGO_URI', 'mongodb://127.0.0.1:27017')
+    os.environ.setdefault('MONGO_DB', 'xivlodestonestats_bench')
+    os.environ.setdefault('MONGO_CHARACTER', 'characters')
+    os.environ.setdefault('MONGO_ENDGAME_METADA', 'metadata')
+    os.environ.setdefault('FFLOGS_CLIENT_ID', 'bench')
+    os.environ.setdefault('FFLOGS_CLIENT_SECRET', 'bench')
+    os.environ['LODESTONE_URL'] = f'http://127.0.0.1:{args.lodestone_port}'
+    os.environ['FFLOGS_URL'] = f'http://127.0.0.1:{args.fflogs_port}'
+    os.environ['INDEX_API_PORT'] = str(args.api_port)
+    os.environ['INDEX_API_URL'] = f'http://127.0.0.1:{args.api_port}'
+
+
+def seed(characters: int):
+    import metadata
+    import utils
+    utils.delete_db()
+    servers = {str(i): {'name': world, 'slug': world.lower(), 'datacenter': datacenter}
+               for i, (world, datacenter) in enumerate(WORLDS)}
+    metadata.save({'regions': {'1': {'name': 'Europe', 'slug': 'EU', 'servers': servers}},
+                   'raids': {str(zone): f'Zone {zone}' for zone in range(50, 56)}})
+    utils.create_empty_documents(characters + 1, progress_every=characters + 1)
+
+
+async def run_for(coroutine, seconds: float) -> float:
+    start = time.perf_counter()
+    task = asyncio.create_task(coroutine)
+    done, _ = await asyncio.wait([task], timeout=seconds)
+    if not done:
+        task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return time.perf_counter() - start
+
+
+async def bench_lodestone(args):
+    import scrapers
+    recorder = Recorder()
+    session = aiohttp.ClientSession(trace_configs=[recorder.trace_config('lodestone')])
+    scraper = scrapers.LodestoneScraper(session, batch_size=args.batch_size, rate=args.rate, max_rate=args.max_rate,
+                                        parse_workers=args.parse_workers)
+    if scraper.parse_pool:
+        scraper.parse_pool.parse = recorder.async_timed('parse', scraper.parse_pool.parse)
+    else:
+        scraper.parser.parse = recorder.timed('parse', scraper.parser.parse)
+    scraper.writer.flush = recorder.async_timed('db_write', scraper.writer.flush)
+    elapsed = await run_for(scraper.scrap(), args.seconds)
+    recorder.report(f'lodestone, limiter ended at {scraper.limiter.rate:.1f} req/s', elapsed)
+
+
+async def bench_fflogs(args):
+    import scrapers
+    recorder = Recorder()
+    session = aiohttp.ClientSession(trace_configs=[recorder.trace_config('fflogs')])
+    scraper = scrapers.FFlogsScraper(session, batch_size=args.batch_size, mode=args.fflogs_mode)
+    scraper.writer.flush = recorder.async_timed('db_write', scraper.writer.flush)
+    try:
+        elapsed = await run_for(scraper.scrap(), args.fflogs_seconds)
+    finally:
+        await scraper.writer.close()
+        await session.close()
+    recorder.report(f'fflogs {args.fflogs_mode}, budget {scraper.budget.stats()}', elapsed)
+
+
+async def bench_free_company(args):
+    import metrics
+    import scrapers
+    import utils
+    print(f'{utils.seed_free_companies()} free companies queued')
+    recorder = Recorder()
+    session = aiohttp.ClientSession(trace_configs=[recorder.trace_config('lodestone_fc')])
+    scraper = scrapers.FreeCompanyScraper(session, batch_size=args.batch_size, rate=args.rate, max_rate=args.max_rate)
+    scraper.parser.parse = recorder.timed('parse', scraper.parser.parse)
+    scraper.writer.flush = recorder.async_timed('db_write', scraper.writer.flush)
+    metrics.enable()
+    elapsed = await run_for(scraper.scrap(), args.fc_seconds)
+    recorder.report(f'free company rosters, members seen {metrics.ROSTER_MEMBERS.values}', elapsed)
+
+
+async def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--characters', type=int, default=5000)
+    arg_parser.add_argument('--seconds', type=float, default=30)
+    arg_parser.add_argument('--fflogs-seconds', type=float, default=20)
+    arg_parser.add_argument('--fc-seconds', type=float, default=10)
+    arg_parser.add_argument('--fflogs-mode', default='current_tier', choices=['simple', 'current_tier', 'old_fights'])
+    arg_parser.add_argument('--batch-size', type=int, default=50)
+    arg_parser.add_argument('--rate', type=float, default=20)
+    arg_parser.add_argument('--max-rate', type=float, default=500)
+    arg_parser.add_argument('--parse-workers', type=int, default=0)
+    arg_parser.add_argument('--latency', type=float, default=0.05)
+    arg_parser.add_argument('--not-found', type=float, default=0.3)
+    arg_parser.add_argument('--throttle-rate', type=float, default=200)
+    arg_parser.add_argument('--fflogs-latency', type=float, default=0.1)
+    args = arg_parser.parse_args()
+    args.lodestone_port, args.fflogs_port, args.api_port = free_port(), free_port(), free_port()
+    configure(args)
+
+    import uvicorn
+    seed(args.characters)
+    import scrap_api
+
+    lodestone = FakeLodestone(args.latency, not_found=args.not_found, throttle_rate=args.throttle_rate,
+                              characters=args.characters)
+    fflogs = FakeFFLogs(args.fflogs_latency)
+    runners = [await serve(lodestone.app(), args.lodestone_port), await serve(fflogs.app(), args.fflogs_port)]
+    api = uvicorn.Server(uvicorn.Config(scrap_api.app, host='127.0.0.1', port=args.api_port, log_level='warning'))
+    api_task = asyncio.create_task(api.serve())
+    while not api.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        await bench_lodestone(args)
+        print(f'fake lodestone statuses: {lodestone.statuses}')
+        if args.fc_seconds:
+            await bench_free_company(args)
+        if args.fflogs_seconds:
+            await bench_fflogs(args)
+            print(f'fake fflogs statuses: {fflogs.statuses}')
+    finally:
+        api.should_exit = True
+        await api_task
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
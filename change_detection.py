@@ -0,0 +1,60 @@
+import hashlib
+import json
+
+# Fields of the scraped payloads that are fingerprinted, everything else is written on every scrape
+LODESTONE_FIELDS = ('name', 'title', 'server', 'datacenter', 'region', 'fc_id', 'jobs')
+FFLOGS_FIELDS = ('name', 'fflogs_id', 'hidden', 'difficulty', 'zone', 'rankings')
+# Lodestone fields a free company member list shows, compared against the lodestone fingerprint
+ROSTER_FIELDS = ('name', 'server', 'datacenter', 'region', 'fc_id')
+# Change log entries kept per character
+CHANGELOG_SIZE = 20
+
+
+def field_hash(value) -> int:
+    """8 byte hash of a field, stored as a signed int so it fits a BSON long"""
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode()
+    return int.from_bytes(hashlib.blake2b(canonical, digest_size=8).digest(), 'big', signed=True)
+
+
+def fingerprint(payload: dict, fields: tuple) -> dict:
+    return {field: field_hash(payload[field]) for field in fields if field in payload}
+
+
+def minimal_update(payload: dict, old_fingerprint: dict, fields: tuple, fingerprint_field: str) -> tuple:
+    """
+        Builds the update of a scraped payload against the fingerprint stored by the previous scrape.
+        Fingerprinted fields are only $set when their hash changed, and $unset when they disappeared.
+        Returns the update document and the list of changed fields, every field counts as changed
+        when there's no previous fingerprint.
+    """
+    new_fingerprint = fingerprint(payload, fields)
+    if old_fingerprint is None:
+        return {"$set": {**payload, fingerprint_field: new_fingerprint}}, list(new_fingerprint)
+
+    changed = [field for field, value in new_fingerprint.items() if old_fingerprint.get(field) != value]
+    removed = [field for field in old_fingerprint if field not in new_fingerprint]
+    update = {"$set": {key: value for key, value in payload.items() if key not in fields or key in changed}}
+    if changed or removed:
+        update["$set"][fingerprint_field] = new_fingerprint
+    if removed:
+        update["$unset"] = {field: '' for field in removed}
+    return update, changed + removed
+
+
+def fflogs_fingerprint_field(mode: str) -> str:
+    """simple and current_tier return different fields, each keeps its own fingerprint so neither unsets the other's"""
+    return f'fflogs_fp.{mode}'
+
+
+def mode_fingerprint(stored, mode: str):
+    """The fingerprint of a mode out of the stored fflogs_fp, None for the flat ones written before the modes split"""
+    fingerprint_value = (stored or {}).get(mode)
+    return fingerprint_value if isinstance(fingerprint_value, dict) else None
+
+
+def jobs_gained(old_jobs: dict, new_jobs: dict) -> dict:
+    return {job: level - old_jobs.get(job, 0) for job, level in new_jobs.items() if level != old_jobs.get(job, 0)}
+
+
+def add_change_log(update: dict, field: str, entry: dict):
+    update.setdefault("$push", {})[field] = {"$each": [entry], "$slice": -CHANGELOG_SIZE}
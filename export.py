@@ -0,0 +1,158 @@
+"""
+    Exports the scrapped characters to a Parquet file, one row per character.
+
+        python export.py characters.parquet
+        python export.py characters_delta.parquet --incremental
+
+    Jobs are flattened to a level column per job of lodestone_parser.JOB_NAMES, fflogs rankings to four columns
+    per encounter. The collection is read with a projection and a batched cursor and written a row group at a
+    time, memory stays at about one row group. Every export stores a watermark, --incremental only exports the
+    characters scrapped or found missing since the last one. Rows of an incremental export replace the ones
+    with the same _id.
+"""
+import argparse
+import os
+import stats
+import sys
+import utils
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import datetime, timedelta
+from lodestone_parser import JOB_NAMES
+from pymongo import MongoClient, ASCENDING
+
+ROW_GROUP_SIZE = int(os.getenv("EXPORT_ROW_GROUP_SIZE", 100_000))
+# Scrapes are stamped before their write is flushed, the watermark is moved back this much so none is missed
+WATERMARK_MARGIN = timedelta(minutes=1)
+WATERMARK_ID = 'export_watermark'
+
+CHARACTER_COLUMNS = [
+    ('_id', pa.int64()),
+    ('name', pa.string()),
+    ('title', pa.string()),
+    ('server', pa.dictionary(pa.int16(), pa.string())),
+    ('datacenter', pa.dictionary(pa.int16(), pa.string())),
+    ('region', pa.dictionary(pa.int8(), pa.string())),
+    ('fc_id', pa.string()),
+    ('exists', pa.bool_()),
+    ('scrapped_lodestone_date', pa.timestamp('ms')),
+    ('fflogs_id', pa.int64()),
+    ('hidden', pa.bool_()),
+    ('scrapped_fflogs_date', pa.timestamp('ms')),
+]
+RANKING_COLUMNS = [
+    ('best_percent', pa.float32()),
+    ('median_percent', pa.float32()),
+    ('total_kills', pa.int32()),
+    ('best_job', pa.dictionary(pa.int16(), pa.string())),
+]
+
+
+def job_column(job: str) -> str:
+    return 'level_' + job.lower().replace(' ', '_')
+
+
+def schema(encounters: list) -> pa.Schema:
+    fields = [pa.field(name, kind) for name, kind in CHARACTER_COLUMNS]
+    # Levels go up to 100, 0 is a job not unlocked yet and null a job the character page didn't list
+    fields += [pa.field(job_column(job), pa.uint8()) for job in JOB_NAMES]
+    fields += [pa.field(f'{name}_{encounter}', kind) for encounter in encounters for name, kind in RANKING_COLUMNS]
+    return pa.schema(fields)
+
+
+def known_encounters(db) -> list:
+    """The encounters stats.Rollups has seen, sorted by id"""
+    cursor = db[utils.STATS_COLLECTION].find({"_id": {"$regex": "^rankings:"}}, ['_id'])
+    return sorted((item['_id'].split(':', 1)[1] for item in cursor), key=lambda _: int(_) if _.isdigit() else _)
+
+
+class RowGroup:
+    """Column lists of the rows of a row group, turned into an arrow table once full"""
+    def __init__(self, export_schema: pa.Schema, encounters: list):
+        self.schema = export_schema
+        self.encounters = set(encounters)
+        self.columns = {name: [] for name in export_schema.names}
+        self.rows = 0
+
+    def add(self, character: dict):
+        for name, _ in CHARACTER_COLUMNS:
+            self.columns[name].append(character.get(name))
+        jobs = character.get('jobs') or {}
+        for job in JOB_NAMES:
+            self.columns[job_column(job)].append(jobs.get(job))
+        rankings = {}
+        for ranking in character.get('rankings') or []:
+            encounter = next(_ for _ in ranking if _ not in stats.RANKING_KEYS)
+            if encounter in self.encounters:
+                rankings[encounter] = ranking
+        for encounter in self.encounters:
+            ranking = rankings.get(encounter, {})
+            for name, _ in RANKING_COLUMNS:
+                self.columns[f'{name}_{encounter}'].append(ranking.get(name))
+        self.rows += 1
+
+    def table(self) -> pa.Table:
+        table = pa.Table.from_pydict(self.columns, schema=self.schema)
+        for values in self.columns.values():
+            values.clear()
+        self.rows = 0
+        return table
+
+
+def export(path: str, incremental: bool = False, encounters: list = None, row_group_size: int = ROW_GROUP_SIZE) -> int:
+    """Writes the characters to path and moves the watermark forward, returns how many rows were written"""
+    db = MongoClient(utils.MONGO_URI)[utils.DATABASE]
+    collection = db[utils.CHARACTER_COLLECTION]
+    # The watermark query is an $or over the dates, each side needs its index
+    collection.create_index([("scrapped_lodestone_date", ASCENDING)])
+    collection.create_index([("scrapped_fflogs_date", ASCENDING)])
+    collection.create_index([("lodestone_missing_date", ASCENDING)])
+
+    watermark = db[utils.ENDGAME_METADATA].find_one({"_id": WATERMARK_ID}) if incremental else None
+    since = watermark['date'] if watermark else utils.EPOCH
+    started = datetime.now()
+    encounters = encounters if encounters is not None else known_encounters(db)
+    export_schema = schema(encounters)
+
+    projection = [name for name, _ in CHARACTER_COLUMNS] + ['jobs', 'rankings']
+    # A character that went missing keeps its scrape dates, only lodestone_missing_date tells it changed
+    cursor = collection.find({"$or": [{"scrapped_lodestone_date": {"$gt": since}},
+                                      {"scrapped_fflogs_date": {"$gt": since}},
+                                      {"lodestone_missing_date": {"$gt": since}}]},
+                             projection, batch_size=min(row_group_size, 10_000))
+    rows = 0
+    row_group = RowGroup(export_schema, encounters)
+    # Written next to the destination and renamed at the end, a failed export leaves the last one in place
+    tmp_path = f'{path}.tmp'
+    with pq.ParquetWriter(tmp_path, export_schema, compression='zstd') as writer:
+        for character in cursor:
+            row_group.add(character)
+            if row_group.rows >= row_group_size:
+                rows += row_group.rows
+                writer.write_table(row_group.table())
+        if row_group.rows:
+            rows += row_group.rows
+            writer.write_table(row_group.table())
+    os.replace(tmp_path, path)
+
+    db[utils.ENDGAME_METADATA].update_one({"_id": WATERMARK_ID},
+                                          {"$set": {'date': started - WATERMARK_MARGIN, 'path': path, 'rows': rows}},
+                                          upsert=True)
+    return rows
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Exports the scrapped characters to Parquet')
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('--incremental', action='store_true', help='only characters scrapped since the last export')
+    arg_parser.add_argument('--encounters', nargs='*', default=None,
+                            help='encounter ids with ranking columns, by default the ones in the stats rollups')
+    arg_parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    args = arg_parser.parse_args()
+    rows = export(args.path, args.incremental, args.encounters, args.row_group_size)
+    print(f'{rows} characters exported to {args.path}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
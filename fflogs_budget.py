@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from rate_limiter import Stopped, pause
+
+
+class PointBudget:
+    """
+        Spreads the fflogs hourly points over the hour.
+        Every query reports rateLimitData back, the points spent between two reports are used to learn
+        the cost of each query type. acquire() waits until a query of that type fits in the pace
+        remaining points / time until reset, when the points run out it sleeps until pointsResetIn.
+        With a stopping event the waits raise rate_limiter.Stopped as soon as it's set.
+    """
+    def __init__(self, default_cost: float = 10.0, smoothing: float = 0.2):
+        self.default_cost = default_cost
+        self.smoothing = smoothing
+        self.limit_per_hour = None
+        self.points_spent = 0.0
+        self.reset_at = time.monotonic() + 3600
+        self.last_spent = None
+        self.costs = {}
+        self.next_dispatch = 0.0
+        self.lock = asyncio.Lock()
+
+    def cost(self, query_type: str) -> float:
+        return self.costs.get(query_type, self.default_cost)
+
+    def update(self, rate_limit_data: dict, query_type: str = None):
+        """Feeds the rateLimitData of a response, query_type is the type of the query that returned it"""
+        spent = rate_limit_data['pointsSpentThisHour']
+        if query_type and self.last_spent is not None and spent > self.last_spent:
+            delta = spent - self.last_spent
+            self.costs[query_type] = delta if query_type not in self.costs else \
+                (1 - self.smoothing) * self.costs[query_type] + self.smoothing * delta
+        self.last_spent = spent
+        self.limit_per_hour = rate_limit_data['limitPerHour']
+        self.points_spent = spent
+        self.reset_at = time.monotonic() + rate_limit_data['pointsResetIn']
+
+    def exhausted(self):
+        """fflogs answered 429, nothing else is sent until the points reset"""
+        if self.limit_per_hour is not None:
+            self.points_spent = self.limit_per_hour
+
+    async def acquire(self, query_type: str, stopping: asyncio.Event = None):
+        cost = self.cost(query_type)
+        async with self.lock:
+            while True:
+                if stopping is not None and stopping.is_set():
+                    raise Stopped
+                now = time.monotonic()
+                if now >= self.reset_at:
+                    # Best guess until the next response tells us the real numbers
+                    self.points_spent, self.last_spent = 0.0, None
+                    self.reset_at = now + 3600
+                if self.limit_per_hour is None:
+                    return
+                remaining = self.limit_per_hour - self.points_spent
+                if remaining < cost:
+                    await pause(self.reset_at - now, stopping)
+                    continue
+                if self.next_dispatch > now:
+                    await pause(self.next_dispatch - now, stopping)
+                    continue
+                self.next_dispatch = now + cost * (self.reset_at - now) / remaining
+                # Reserved until the response reports the real spend
+                self.points_spent += cost
+                return
+
+    def stats(self) -> dict:
+        return {
+            'limit_per_hour': self.limit_per_hour,
+            'points_spent': self.points_spent,
+            'points_remaining': None if self.limit_per_hour is None else self.limit_per_hour - self.points_spent,
+            'reset_in': max(self.reset_at - time.monotonic(), 0),
+            'costs': dict(self.costs),
+        }
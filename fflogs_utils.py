@@ -1,15 +1,16 @@
+import aiohttp
+import metadata
 import requests
-import utils
 import os
-from pymongo import MongoClient
 
 
 # FFLogs related "constants"
 CLIENT_ID = os.getenv("FFLOGS_CLIENT_ID")
 CLIENT_SECRET = os.getenv("FFLOGS_CLIENT_SECRET")
-AUTH_URL = "https://www.fflogs.com/oauth/authorize"
-TOKEN_URL = "https://www.fflogs.com/oauth/token"
-API_URL = "https://www.fflogs.com/api/v2/client"
+FFLOGS_URL = os.getenv("FFLOGS_URL", "https://www.fflogs.com")
+AUTH_URL = f"{FFLOGS_URL}/oauth/authorize"
+TOKEN_URL = f"{FFLOGS_URL}/oauth/token"
+API_URL = f"{FFLOGS_URL}/api/v2/client"
 
 zone_query = '''{
     worldData{
@@ -56,9 +57,55 @@ fflogs_old_tiers = '''{{
 }}
 '''
 
-points_info_query = '''{
-    rateLimitData{ limitPerHour, pointsSpentThisHour, pointsResetIn}
-}'''
+# Fields selected on each character by the batched queries, {} is filled with the extra fields
+# needed when the character is looked up by name
+basic_fields = 'name, lodestoneID, canonicalID, hidden'
+current_tier_fields = 'lodestoneID {} zoneRankings'
+old_tiers_fields = 'lodestoneID {} {}'
+
+rate_limit_fields = 'rateLimitData{ limitPerHour, pointsSpentThisHour, pointsResetIn}'
+
+points_info_query = f'''{{
+    {rate_limit_fields}
+}}'''
+
+
+def batched_character_query(selections: list) -> str:
+    """
+        Packs several character lookups in one document, each one under its own alias.
+        selections is a list of (filter, fields), the character of selections[i] is returned as c{i}.
+        rateLimitData is always asked for so the points spent can be tracked without extra requests.
+    """
+    aliased = '\n'.join(f'        c{i}: character({character_filter}) {{{fields}}}'
+                         for i, (character_filter, fields) in enumerate(selections))
+    return f'{{\n    characterData {{\n{aliased}\n    }}\n    {rate_limit_fields}\n}}\n'
+
+
+def split_batched_response(response: dict, n_aliases: int) -> list:
+    """
+        Splits the response of batched_character_query into one (response, error) per alias.
+        The response has the shape of a single character query so the usual cleaning applies to it,
+        it is None when fflogs doesn't know the character. Errors are reported per alias by graphql.
+    """
+    character_data = (response.get('data') or {}).get('characterData') or {}
+    errors = {}
+    for error in response.get('errors') or []:
+        path = error.get('path') or []
+        alias = path[1] if len(path) > 1 else None
+        errors[alias] = error.get('message', 'unknown error')
+
+    result = []
+    for i in range(n_aliases):
+        alias = f'c{i}'
+        # Errors without a path break the whole document
+        error = errors.get(alias) or (errors.get(None) if not character_data else None)
+        if error:
+            result.append((None, error))
+        elif character_data.get(alias) is None:
+            result.append((None, None))
+        else:
+            result.append(({'data': {'characterData': {'character': character_data[alias]}}}, None))
+    return result
 
 
 def get_fflogs_token():
@@ -68,9 +115,14 @@ def get_fflogs_token():
     return token_res.json()
 
 
+async def aio_get_fflogs_token(session) -> dict:
+    async with session.post(TOKEN_URL, data={'grant_type': 'client_credentials'}, ssl=False,
+                            allow_redirects=False, auth=aiohttp.BasicAuth(CLIENT_ID, CLIENT_SECRET)) as response:
+        return await response.json()
+
+
 def create_metadata_collections():
-    mongo_client = MongoClient(utils.MONGO_URI)
-    db = mongo_client[utils.DATABASE]
+    """Fetches the zones and servers from fflogs and stores them with metadata.save, it can be run again any time"""
     # generate data regarding raid zones from fflogs API
     tokens = get_fflogs_token()
     headers = {'Content-Type': "application/json", 'Authorization': 'Bearer ' + tokens['access_token']}
@@ -111,6 +163,6 @@ def create_metadata_collections():
         }
         datacenters[str(item['id'])] = {'name': item['name'], 'slug': item['slug'], 'servers': region_servers}
 
-    db['metadata'].insert_many([adapted_api_data, {'fights': fights},
-                                {'difficulties': difficulties}, {'expansion': expansion},
-                                {'raids': raid_zones}, {'regions': datacenters}])
+    return metadata.save({'worldData': adapted_api_data['worldData'], 'fights': fights,
+                          'difficulties': difficulties, 'expansion': expansion,
+                          'raids': raid_zones, 'regions': datacenters})
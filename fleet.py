@@ -0,0 +1,131 @@
+"""
+    Runs a fleet of scraper worker processes and keeps it running.
+
+        python fleet.py lodestone --workers 4 --batch-size 20 --rate 20
+        python fleet.py fflogs --workers 2 --mode current_tier
+        python fleet.py lodestone+freecompany --workers 4 --rate 20
+
+    Every worker claims from its own shard of the id space through the API, so workers never compete for the
+    same documents. To spread a fleet over several hosts give every host the same --total-shards and its own
+    --first-shard, two hosts with 4 workers each are --total-shards 8 with --first-shard 0 and --first-shard 4.
+    Crashed workers are restarted, SIGTERM (or ctrl+c) lets every worker flush its writes before exiting.
+    lodestone+freecompany runs both scrapers in every worker, sharing the worker's share of the lodestone rate.
+    Two separate fleets for them would each take the whole --rate.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import signal
+import sys
+import time
+
+# A worker that keeps crashing waits longer before every restart, up to this many seconds
+MAX_RESTART_DELAY = 60
+# A worker that ran this long counts as healthy again
+HEALTHY_AFTER = 300
+
+
+def run_worker(kind: str, options: dict):
+    # Only the supervisor decides when the fleet stops, ctrl+c in a terminal reaches every process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import scrapers
+    asyncio.run(scrapers.main(kind, **options))
+
+
+class Worker:
+    def __init__(self, name: str, kind: str, options: dict):
+        self.name = name
+        self.kind = kind
+        self.options = options
+        self.process = None
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self):
+        self.process = multiprocessing.Process(target=run_worker, args=(self.kind, self.options), name=self.name)
+        self.process.start()
+        self.started = time.monotonic()
+
+    def check(self):
+        """Restarts the worker if it exited, backing off when it keeps exiting"""
+        if self.process.is_alive():
+            return
+        now = time.monotonic()
+        if self.restart_at is None:
+            self.failures = 0 if now - self.started > HEALTHY_AFTER else self.failures + 1
+            self.restart_at = now + min(2 ** self.failures - 1, MAX_RESTART_DELAY)
+            print(f'{self.name} exited with code {self.process.exitcode}, restarting in '
+                  f'{self.restart_at - now:.0f}s', file=sys.stderr)
+        if now >= self.restart_at:
+            self.restart_at = None
+            self.start()
+
+
+def worker_options(args, index: int) -> dict:
+    options = {'batch_size': args.batch_size}
+    kinds = args.kind.split('+')
+    if kinds != ['freecompany']:
+        # Free company ids aren't numbers, those workers share the queue and rely on the leases alone
+        options.update(shard=args.first_shard + index, shards=args.total_shards or args.workers)
+    if 'freecompany' in kinds:
+        # Names the journal of the worker, see scrapers.open_journal
+        options['worker'] = args.first_shard + index
+    if 'lodestone' in kinds or 'freecompany' in kinds:
+        # Lodestone limits per address, the workers of a host share the rate
+        options.update(rate=args.rate / args.workers, max_rate=args.max_rate / args.workers)
+    if 'lodestone' in kinds:
+        options['parse_workers'] = args.parse_workers
+    if args.kind == 'fflogs':
+        options['mode'] = args.mode
+    if args.metrics_port:
+        options['metrics_port'] = args.metrics_port + index
+    return options
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Runs scraper worker processes, restarting the ones that crash')
+    arg_parser.add_argument('kind', choices=['lodestone', 'fflogs', 'freecompany', 'lodestone+freecompany'])
+    arg_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    arg_parser.add_argument('--batch-size', type=int, default=20, help='documents claimed at once by each worker')
+    arg_parser.add_argument('--total-shards', type=int, default=None, help='shards of the whole fleet, all hosts')
+    arg_parser.add_argument('--first-shard', type=int, default=0, help='shard of the first worker of this host')
+    arg_parser.add_argument('--rate', type=float, default=5.0, help='lodestone requests per second of this host')
+    arg_parser.add_argument('--max-rate', type=float, default=50.0)
+    arg_parser.add_argument('--parse-workers', type=int, default=0)
+    arg_parser.add_argument('--mode', default='simple', choices=['simple', 'current_tier', 'old_fights'])
+    arg_parser.add_argument('--metrics-port', type=int, default=None, help='first port, one per worker')
+    arg_parser.add_argument('--drain-timeout', type=float, default=60)
+    args = arg_parser.parse_args()
+
+    workers = [Worker(f'{args.kind}-{args.first_shard + i}', args.kind, worker_options(args, i))
+               for i in range(args.workers)]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.start()
+    while not stopping:
+        time.sleep(1)
+        for worker in workers:
+            worker.check()
+
+    print(f'draining {len(workers)} workers', file=sys.stderr)
+    for worker in workers:
+        if worker.process.is_alive():
+            worker.process.terminate()
+    deadline = time.monotonic() + args.drain_timeout
+    for worker in workers:
+        worker.process.join(max(deadline - time.monotonic(), 0))
+        if worker.process.is_alive():
+            print(f'{worker.name} did not drain in time, killing it', file=sys.stderr)
+            worker.process.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import bson
+import json
+import sqlite3
+
+from pymongo import UpdateOne
+
+
+class Journal:
+    """
+        Local sqlite record of what a scraper has in hand: the ids it claimed and hasn't finished, with how many
+        times they failed, and the write operations not flushed to mongo yet. After a crash or a restart the
+        scraper picks the same ids up again and the writers flush what was left, nothing waits for a lease
+        to expire. An in memory journal (':memory:') only lasts as long as the process.
+    """
+    def __init__(self, path: str = ':memory:'):
+        self.db = sqlite3.connect(path)
+        # WAL with synchronous NORMAL survives a crash of the process, only a power loss can take the last commits
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS claims (id INTEGER PRIMARY KEY, attempts INTEGER NOT NULL '
+                            'DEFAULT 0, fingerprint TEXT, schedule TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS updates (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            'target TEXT NOT NULL, operation BLOB NOT NULL)')
+
+    def claim(self, ids: list, fingerprints: dict = None, schedule: dict = None):
+        """Records the ids handed out by the API along with the state the scrape of each one needs"""
+        fingerprints, schedule = fingerprints or {}, schedule or {}
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO claims (id, fingerprint, schedule) VALUES (?, ?, ?)',
+                                [(_, json.dumps(fingerprints.get(_)), json.dumps(schedule.get(_))) for _ in ids])
+
+    def claimed(self) -> dict:
+        """id -> (fingerprint, schedule) of every id in hand, used to restore the scraper state on start"""
+        rows = self.db.execute('SELECT id, fingerprint, schedule FROM claims ORDER BY id')
+        return {_id: (json.loads(fingerprint), json.loads(schedule)) for _id, fingerprint, schedule in rows}
+
+    def claimed_ids(self) -> list:
+        return [_id for _id, in self.db.execute('SELECT id FROM claims ORDER BY id')]
+
+    def retries(self) -> int:
+        return self.db.execute('SELECT count(*) FROM claims WHERE attempts > 0').fetchone()[0]
+
+    def done(self, ids: list):
+        with self.db:
+            self.db.executemany('DELETE FROM claims WHERE id = ?', [(_,) for _ in ids])
+
+    def failed(self, ids: list, max_attempts: int) -> list:
+        """Counts a failed attempt for every id, the ones out of attempts are dropped and returned"""
+        with self.db:
+            self.db.executemany('UPDATE claims SET attempts = attempts + 1 WHERE id = ?', [(_,) for _ in ids])
+            dropped = [_id for _id, in self.db.execute('SELECT id FROM claims WHERE attempts >= ?', (max_attempts,))]
+            self.db.executemany('DELETE FROM claims WHERE id = ?', [(_,) for _ in dropped])
+        return dropped
+
+    def add_update(self, target: str, operation: UpdateOne) -> int:
+        """Not committed until commit(), done() or flushed(), a scraper commits the writes of a batch at once"""
+        # pymongo has no public accessors for the parts of an operation
+        document = {'filter': operation._filter, 'update': operation._doc, 'upsert': bool(operation._upsert)}
+        return self.db.execute('INSERT INTO updates (target, operation) VALUES (?, ?)',
+                               (target, bson.encode(document))).lastrowid
+
+    def commit(self):
+        self.db.commit()
+
+    def flushed(self, seqs: list):
+        with self.db:
+            self.db.executemany('DELETE FROM updates WHERE seq = ?', [(_,) for _ in seqs])
+
+    def unflushed(self, target: str) -> list:
+        """(operation, seq) of the writes of target that never reached mongo, oldest first"""
+        rows = self.db.execute('SELECT seq, operation FROM updates WHERE target = ? ORDER BY seq', (target,))
+        result = []
+        for seq, operation in rows:
+            document = bson.decode(operation)
+            result.append((UpdateOne(document['filter'], document['update'], upsert=document['upsert']), seq))
+        return result
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,192 @@
+import abc
+import asyncio
+import html
+import re
+
+from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+
+
+def world_tables(regions: dict) -> tuple:
+    """
+        Builds the world name -> slug and slug -> region tables from the regions metadata document.
+        Only the regions lodestone has characters in are kept.
+    """
+    worlds, slug_regions = {}, {}
+    for key, tmp in regions.items():
+        if tmp['slug'] not in ['EU', 'NA', 'JP', 'OC']:
+            continue
+        for _, item in tmp['servers'].items():
+            worlds[item['name']] = item['slug']
+            slug_regions[item['slug']] = tmp['slug']
+    return worlds, slug_regions
+
+
+# Every job as CharacterParser.job_name returns it, in the order the lodestone level lists show them
+JOB_NAMES = ('Paladin', 'Warrior', 'Dark Knight', 'Gunbreaker', 'White Mage', 'Scholar', 'Astrologian', 'Sage',
+             'Monk', 'Dragoon', 'Ninja', 'Samurai', 'Reaper', 'Viper', 'Bard', 'Machinist', 'Dancer',
+             'Black Mage', 'Summoner', 'Red Mage', 'Pictomancer', 'Blue Mage',
+             'Carpenter', 'Blacksmith', 'Armorer', 'Goldsmith', 'Leatherworker', 'Weaver', 'Alchemist', 'Culinarian',
+             'Miner', 'Botanist', 'Fisher')
+
+
+class CharacterParser(abc.ABC):
+    """Extracts the character fields we store from a lodestone character page."""
+    def __init__(self, worlds: dict, regions: dict):
+        self.worlds = worlds
+        self.regions = regions
+
+    @abc.abstractmethod
+    def parse(self, character_page: str) -> dict:
+        """The character fields of the page"""
+
+    def set_world(self, tmp: dict, world_dc: str):
+        tmp['server'], tmp['datacenter'] = world_dc.split(' ')
+        tmp['datacenter'] = tmp['datacenter'].replace('[', '').replace(']', '')
+        tmp['server'] = self.worlds[tmp['server']]
+        tmp['region'] = self.regions[tmp['server']]
+
+    @staticmethod
+    def job_name(tooltip: str) -> str:
+        # TODO: Normalize classes/jobs names
+        return tooltip.replace(' (Limited Job)', '').split(' / ')[0]
+
+
+class SoupParser(CharacterParser):
+    """Reference implementation, builds the whole BeautifulSoup tree."""
+    def parse(self, character_page: str) -> dict:
+        tmp = {}
+        soup = BeautifulSoup(character_page, 'html.parser')
+        tmp['name'] = soup.find('p', class_='frame__chara__name').text
+        title_tag = soup.find('p', class_='frame__chara__title')
+        if title_tag:
+            tmp['title'] = title_tag.text
+        self.set_world(tmp, soup.find('p', class_='frame__chara__world').text)
+        # Not all characters are in a free company
+        try:
+            a_tag = soup.find('div', class_='character__freecompany__name').find('a')
+            # -2 due to the / at the end of the url
+            tmp['fc_id'] = a_tag.get('href').split('/')[-2]
+        except AttributeError:
+            tmp['fc_id'] = None
+
+        tmp['jobs'] = {
+            self.job_name(li.img.get('data-tooltip')): 0 if li.text == '-' else int(li.text)
+            for li in [x for y in soup.find_all('div', class_='character__level__list') for x in y.find_all('li')]
+        }
+
+        return tmp
+
+
+def _element(tag: str, css_class: str):
+    return re.compile(rf'<{tag}\b[^>]*\bclass="(?:[^"]*\s)?{css_class}(?:\s[^"]*)?"[^>]*>(.*?)</{tag}>', re.S)
+
+
+def _text(fragment: str) -> str:
+    return html.unescape(_TAG.sub('', fragment))
+
+
+_TAG = re.compile(r'<[^>]*>')
+_NAME = _element('p', 'frame__chara__name')
+_TITLE = _element('p', 'frame__chara__title')
+_WORLD = _element('p', 'frame__chara__world')
+_FREE_COMPANY = _element('div', 'character__freecompany__name')
+_LEVEL_LIST = _element('div', 'character__level__list')
+_LI = re.compile(r'<li\b[^>]*>(.*?)</li>', re.S)
+_HREF = re.compile(r'<a\b[^>]*\bhref="([^"]*)"')
+_TOOLTIP = re.compile(r'<img\b[^>]*\bdata-tooltip="([^"]*)"')
+
+
+class FastParser(CharacterParser):
+    """
+        Only looks for the handful of elements we store with precompiled regular expressions,
+        no tree is built. Must return exactly what SoupParser returns, see benchmarks/parse_bench.py
+    """
+    def parse(self, character_page: str) -> dict:
+        tmp = {'name': _text(_NAME.search(character_page).group(1))}
+        title_tag = _TITLE.search(character_page)
+        if title_tag:
+            tmp['title'] = _text(title_tag.group(1))
+        self.set_world(tmp, _text(_WORLD.search(character_page).group(1)))
+        free_company = _FREE_COMPANY.search(character_page)
+        a_tag = _HREF.search(free_company.group(1)) if free_company else None
+        tmp['fc_id'] = html.unescape(a_tag.group(1)).split('/')[-2] if a_tag else None
+
+        jobs = {}
+        for level_list in _LEVEL_LIST.finditer(character_page):
+            for li in _LI.finditer(level_list.group(1)):
+                level = _text(li.group(1))
+                jobs[self.job_name(html.unescape(_TOOLTIP.search(li.group(1)).group(1)))] = \
+                    0 if level == '-' else int(level)
+        tmp['jobs'] = jobs
+
+        return tmp
+
+
+PARSERS = {'soup': SoupParser, 'fast': FastParser}
+
+
+_MEMBER = re.compile(r'<a\b[^>]*\bhref="/lodestone/character/(\d+)/"[^>]*\bclass="entry__bg"[^>]*>(.*?)</a>', re.S)
+_MEMBER_NAME = _element('p', 'entry__name')
+_MEMBER_WORLD = _element('p', 'entry__world')
+_MEMBER_RANK = _element('ul', 'entry__freecompany__info')
+_SPAN = re.compile(r'<span\b[^>]*>(.*?)</span>', re.S)
+_PAGER = _element('li', 'btn__pager__current')
+
+
+class RosterParser(CharacterParser):
+    """
+        Parses a free company member list, /lodestone/freecompany/{id}/member/?page=N.
+        Every entry has the character id, name, world and free company rank, pages tells how many pages the list has.
+    """
+    def parse(self, member_page: str) -> dict:
+        members = []
+        for member in _MEMBER.finditer(member_page):
+            entry = member.group(2)
+            tmp = {'_id': int(member.group(1)), 'name': _text(_MEMBER_NAME.search(entry).group(1))}
+            self.set_world(tmp, _text(_MEMBER_WORLD.search(entry).group(1)).strip())
+            rank = _MEMBER_RANK.search(entry)
+            span = _SPAN.search(rank.group(1)) if rank else None
+            tmp['fc_rank'] = _text(span.group(1)) if span else None
+            members.append(tmp)
+        # Page 1 of 3
+        pager = _PAGER.search(member_page)
+        return {'members': members, 'pages': int(_text(pager.group(1)).split()[-1]) if pager else 1}
+
+
+# Parser of the current worker process, set once by init_worker so the tables aren't sent with every page
+_worker_parser = None
+
+
+def init_worker(backend: str, worlds: dict, regions: dict):
+    global _worker_parser
+    _worker_parser = PARSERS[backend](worlds, regions)
+
+
+def parse_in_worker(character_page: str) -> dict:
+    return _worker_parser.parse(character_page)
+
+
+class ParserPool:
+    """
+        Parses character pages in worker processes so a scraper isn't limited to one core.
+        At most max_pending pages are held in memory, callers wait on slots before reading a page body.
+    """
+    def __init__(self, backend: str, worlds: dict, regions: dict, workers: int, max_pending: int = None):
+        self.backend = backend
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(backend, worlds, regions))
+        self.slots = asyncio.Semaphore(max_pending or workers * 4)
+
+    def reload(self, worlds: dict, regions: dict):
+        """New workers with new tables, the old ones finish the pages they were given"""
+        old = self.executor
+        self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                            initargs=(self.backend, worlds, regions))
+        old.shutdown(wait=False)
+
+    async def parse(self, character_page: str) -> dict:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, parse_in_worker, character_page)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,168 @@
+import change_detection
+import json
+import lodestone_parser
+import os
+import time
+import utils
+
+from datetime import datetime
+from types import MappingProxyType
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import PyMongoError
+
+# Every metadata document lives under its kind as _id, {_id: 'raids', 'raids': {...}, 'hash': ..., 'version': ...}
+KINDS = ('worldData', 'fights', 'difficulties', 'expansion', 'raids', 'regions')
+VERSION_ID = 'metadata_version'
+# Optional json copy of the last metadata loaded, lets a process start without waiting on mongo
+SNAPSHOT_PATH = os.getenv("METADATA_SNAPSHOT")
+# Seconds between the version checks of the scrapers, they also check right away when a page has an unknown world
+REFRESH_INTERVAL = float(os.getenv("METADATA_REFRESH_SECONDS", 300))
+
+_cache = None
+_clients = {}
+# time.monotonic() of the last version check of async_refresh
+_checked = 0.0
+
+
+class Metadata:
+    """Read only lookup tables built once from the metadata documents, shared by everything in the process"""
+    __slots__ = ('version', 'documents', 'worlds', 'regions', 'servers', 'zones', 'encounters')
+
+    def __init__(self, version: int, documents: dict):
+        self.version = version
+        self.documents = MappingProxyType(documents)
+        worlds, regions = lodestone_parser.world_tables(documents.get('regions', {}))
+        # world name -> slug and slug -> region slug, the ones the lodestone parsers need
+        self.worlds = MappingProxyType(worlds)
+        self.regions = MappingProxyType(regions)
+        # slug -> name, datacenter and region of every server
+        self.servers = MappingProxyType({
+            server['slug']: MappingProxyType({'name': server['name'], 'datacenter': server['datacenter'],
+                                              'region': region['slug']})
+            for region in documents.get('regions', {}).values() for server in region['servers'].values()})
+        # zone id -> name and encounter id -> name, ids as strings like in the documents
+        self.zones = MappingProxyType(documents.get('raids', {}))
+        self.encounters = MappingProxyType(documents.get('fights', {}))
+
+
+def database(timeout_ms: int = None):
+    if timeout_ms not in _clients:
+        _clients[timeout_ms] = MongoClient(utils.MONGO_URI, serverSelectionTimeoutMS=timeout_ms) if timeout_ms \
+            else MongoClient(utils.MONGO_URI)
+    return _clients[timeout_ms][utils.DATABASE][utils.ENDGAME_METADATA]
+
+
+def save(documents: dict) -> int:
+    """
+        Upserts the given kind -> value metadata documents. Only the ones whose content changed are written,
+        and if any did the version goes up so every process reloads. Returns the current version.
+        Documents left by the old insert_many of the same kind are removed.
+    """
+    collection = database()
+    changed = False
+    for kind, value in documents.items():
+        content_hash = change_detection.field_hash(value)
+        if collection.delete_many({kind: {"$exists": True}, "_id": {"$ne": kind}}).deleted_count:
+            changed = True
+        stored = collection.find_one({"_id": kind}, ['hash'])
+        if stored is not None and stored.get('hash') == content_hash:
+            continue
+        collection.replace_one({"_id": kind}, {kind: value, 'hash': content_hash, 'date': datetime.now()},
+                               upsert=True)
+        changed = True
+    if not changed:
+        return current_version(collection)
+    version = collection.find_one_and_update({"_id": VERSION_ID}, {"$inc": {"version": 1}},
+                                             upsert=True, return_document=ReturnDocument.AFTER)['version']
+    collection.update_many({"_id": {"$in": list(documents)}}, {"$set": {"version": version}})
+    return version
+
+
+def current_version(collection) -> int:
+    item = collection.find_one({"_id": VERSION_ID})
+    return item['version'] if item else 0
+
+
+def from_items(items) -> dict:
+    """Picks the document of every kind, the versioned one over the leftovers of older versions"""
+    documents = {}
+    for item in items:
+        for kind in KINDS:
+            if kind in item and (kind not in documents or item['_id'] == kind):
+                documents[kind] = item[kind]
+    return documents
+
+
+def kinds_filter() -> dict:
+    return {"$or": [{kind: {"$exists": True}} for kind in KINDS]}
+
+
+def load() -> Metadata:
+    collection = database()
+    return Metadata(current_version(collection), from_items(collection.find(kinds_filter())))
+
+
+def read_snapshot():
+    if not SNAPSHOT_PATH or not os.path.exists(SNAPSHOT_PATH):
+        return None
+    with open(SNAPSHOT_PATH) as file:
+        snapshot = json.load(file)
+    return Metadata(snapshot['version'], snapshot['documents'])
+
+
+def write_snapshot(loaded: Metadata):
+    if not SNAPSHOT_PATH:
+        return
+    tmp_path = f'{SNAPSHOT_PATH}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'version': loaded.version, 'documents': dict(loaded.documents)}, file)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+
+def get() -> Metadata:
+    """
+        The metadata of this process, loaded on the first call. With a snapshot only the version is asked to mongo,
+        and if mongo can't be reached the snapshot is used as it is.
+    """
+    global _cache
+    if _cache is None:
+        _cache = read_snapshot()
+        if _cache is None:
+            _cache = load()
+            write_snapshot(_cache)
+        else:
+            refresh(timeout_ms=2000)
+    return _cache
+
+
+def refresh(timeout_ms: int = None) -> Metadata:
+    """Reloads the metadata if its version changed since it was loaded"""
+    global _cache
+    try:
+        version = current_version(database(timeout_ms))
+    except PyMongoError:
+        if _cache is None:
+            raise
+        return _cache
+    if _cache is None or _cache.version != version:
+        _cache = load()
+        write_snapshot(_cache)
+    return _cache
+
+
+async def async_refresh(db, max_age: float = 0) -> Metadata:
+    """
+        refresh() for a motor database, the version check is a single find_one by _id.
+        With max_age the version isn't checked again until that many seconds have passed since the last check.
+    """
+    global _cache, _checked
+    if _cache is not None and time.monotonic() - _checked < max_age:
+        return _cache
+    _checked = time.monotonic()
+    collection = db[utils.ENDGAME_METADATA]
+    item = await collection.find_one({"_id": VERSION_ID})
+    version = item['version'] if item else 0
+    if _cache is None or _cache.version != version:
+        _cache = Metadata(version, from_items(await collection.find(kinds_filter()).to_list(None)))
+        write_snapshot(_cache)
+    return _cache
@@ -0,0 +1,165 @@
+import time
+
+from aiohttp import web
+
+# Nothing is recorded until enable() is called, the hot paths only pay for this check
+_enabled = False
+_metrics = []
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def _series(name: str, labels: str) -> str:
+    return f'{name}{{{labels}}}' if labels else name
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        if not _enabled:
+            return
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter'] + \
+            [f'{_series(self.name, _labels(self.label_names, key))} {value}' for key, value in self.values.items()]
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(*self.label_values, value=time.perf_counter() - self.start)
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Histogram:
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, *label_values, value: float):
+        if not _enabled:
+            return
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, *label_values):
+        return _Timer(self, label_values) if _enabled else _NO_TIMER
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for key, series in self.values.items():
+            labels = _labels(self.label_names, key)
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bucket, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{separator}le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}{separator}le="+Inf"}} {series[-1]}')
+            lines.append(f'{_series(self.name + "_sum", labels)} {series[-2]}')
+            lines.append(f'{_series(self.name + "_count", labels)} {series[-1]}')
+        return lines
+
+
+class Gauge:
+    """The value is read from a callback when the metrics are rendered, so it costs nothing in between"""
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.callbacks = {}
+        _metrics.append(self)
+
+    def set_function(self, function, *label_values):
+        self.callbacks[label_values] = function
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge'] + \
+            [f'{_series(self.name, _labels(self.label_names, key))} {function()}'
+             for key, function in self.callbacks.items()]
+
+
+STAGE_SECONDS = Histogram('xiv_stage_seconds', 'Time spent per stage', ('stage',))
+RESPONSES = Counter('xiv_responses_total', 'Upstream responses by source and status', ('source', 'status'))
+CLAIMED = Counter('xiv_claimed_total', 'Documents handed out by the API', ('queue',))
+QUEUE_DEPTH = Gauge('xiv_queue_depth', 'Items waiting in a scraper queue', ('queue',))
+ROSTER_MEMBERS = Counter('xiv_roster_members_total', 'Characters seen in free company member lists', ('result',))
+LEASES = Gauge('xiv_leases', 'Documents currently leased to scrapers', ('queue',))
+LODESTONE_RATE = Gauge('xiv_lodestone_rate', 'Requests per second allowed by the lodestone rate limiter')
+FFLOGS_POINTS = Gauge('xiv_fflogs_points_remaining', 'FFLogs points left until the hourly reset')
+
+
+def status_label(status: int):
+    return status if status in (200, 404, 429) else 'other'
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type='text/plain')
+
+
+async def start_server(port: int, host: str = '0.0.0.0') -> web.AppRunner:
+    """Serves /metrics from a scraper process"""
+    enable()
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,110 @@
+import asyncio
+import metrics
+import sys
+import traceback
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# Attempts of a flush when mongo can't be reached, waiting twice as long every time up to MAX_RETRY_DELAY
+FLUSH_ATTEMPTS = 6
+MAX_RETRY_DELAY = 30
+
+
+class BulkWriter:
+    """
+        Buffers mongo write operations and flushes them with bulk_write from a background task.
+        The queue is bounded so producers slow down when the database can't keep up, while a
+        flush is in flight the scrapers keep fetching and filling the next batch.
+        With a journal every operation is kept there, under name, until it's flushed, and the ones a previous
+        run left behind are flushed first.
+        If mongo stays unreachable through every retry the writer gives up: put() raises the error from then on
+        instead of blocking on a queue nobody drains.
+    """
+    def __init__(self, collection, flush_size: int = 500, flush_interval: float = 2.0, max_pending: int = 5000,
+                 journal=None, name: str = None):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.task = None
+        self.journal = journal
+        self.name = name or collection.name
+        # The error the writer gave up on, None while it's running
+        self.error = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def put(self, operation):
+        if self.error:
+            raise self.error
+        seq = self.journal.add_update(self.name, operation) if self.journal else None
+        await self.queue.put((operation, seq))
+
+    async def close(self):
+        """Flushes whatever is pending and stops the background task"""
+        if self.task is None:
+            return
+        if not self.task.done():
+            await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def run(self):
+        try:
+            await self.consume()
+        except PyMongoError as e:
+            self.fail(e)
+
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        if self.journal:
+            unflushed = self.journal.unflushed(self.name)
+            for i in range(0, len(unflushed), self.flush_size):
+                await self.flush(unflushed[i:i + self.flush_size])
+        while not closing:
+            batch = []
+            operation = await self.queue.get()
+            deadline = loop.time() + self.flush_interval
+            while operation is not None:
+                batch.append(operation)
+                if len(batch) >= self.flush_size:
+                    break
+                try:
+                    operation = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+            closing = operation is None
+            if batch:
+                await self.flush(batch)
+
+    def fail(self, error: PyMongoError):
+        """Stops taking operations, the ones queued are dropped so the producers waiting on put() wake up"""
+        print(f'Giving up on writes to {self.name}: {error!r}', file=sys.stderr)
+        self.error = error
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def flush(self, batch: list):
+        """batch holds (operation, journal seq) pairs, raises the last error if mongo can't be reached"""
+        operations = [operation for operation, _ in batch]
+        for attempt in range(FLUSH_ATTEMPTS):
+            try:
+                with metrics.STAGE_SECONDS.time('bulk_write'):
+                    await self.collection.bulk_write(operations, ordered=False)
+                break
+            except BulkWriteError:
+                # A bad operation shouldn't take the rest of the scraper down with it
+                print(traceback.format_exc(), file=sys.stderr)
+                break
+            except PyMongoError as e:
+                if attempt == FLUSH_ATTEMPTS - 1:
+                    raise
+                delay = min(2 ** attempt, MAX_RETRY_DELAY)
+                print(f'Flush to {self.name} failed ({e!r}), retrying in {delay}s', file=sys.stderr)
+                await asyncio.sleep(delay)
+        # Only written or rejected operations leave the journal, the ones given up on are there for the next run
+        if self.journal:
+            self.journal.flushed([seq for _, seq in batch])
@@ -0,0 +1,219 @@
+"""
+    Archive of the raw lodestone pages, so they can be parsed again without crawling lodestone again.
+
+        python page_archive.py replay /data/pages --workers 8
+        python page_archive.py show /data/pages 12345
+
+    Pages are zlib compressed one by one and appended to segment files, a new segment is started once one
+    reaches the segment size. Every segment has an index next to it with the character id, status, date and
+    offset of each record, so a page can be found without reading the segments. Segment names start with
+    the time they were opened, several scrapers can share a directory.
+"""
+import argparse
+import asyncio
+import lodestone_parser
+import metadata
+import os
+import struct
+import sys
+import time
+import utils
+import zlib
+
+from change_detection import LODESTONE_FIELDS, fingerprint
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+SEGMENT_SIZE = int(os.getenv("PAGE_ARCHIVE_SEGMENT_MB", 256)) * 1024 * 1024
+# character id, date in milliseconds since utils.EPOCH, status, length of the compressed page
+RECORD = struct.Struct('>qqHI')
+# the same plus the offset of the record in its segment
+INDEX_ENTRY = struct.Struct('>qqHIQ')
+
+
+def to_ms(date) -> int:
+    return (date - utils.EPOCH) // timedelta(milliseconds=1)
+
+
+def from_ms(ms: int):
+    return utils.EPOCH + timedelta(milliseconds=ms)
+
+
+class PageArchive:
+    """
+        Appends pages to the current segment. Compression and writes happen on a single thread
+        so the event loop isn't held up and records keep their order.
+    """
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE, level: int = 6):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.level = level
+        self.segment = None
+        self.index = None
+        self.size = 0
+        self.executor = ThreadPoolExecutor(1)
+
+    def rotate(self):
+        self.close_segment()
+        name = os.path.join(self.directory, f'{time.time_ns() // 1_000_000:013d}-{os.getpid()}')
+        self.segment = open(f'{name}.pages', 'ab')
+        self.index = open(f'{name}.idx', 'ab')
+        self.size = 0
+
+    def close_segment(self):
+        if self.segment:
+            self.segment.close()
+            self.index.close()
+            self.segment = self.index = None
+
+    def append(self, character_id: int, date, status: int, page: str):
+        data = zlib.compress(page.encode(), self.level)
+        if self.segment is None or self.size >= self.segment_size:
+            self.rotate()
+        ms = to_ms(date)
+        self.segment.write(RECORD.pack(character_id, ms, status, len(data)) + data)
+        # The index is written after the record, a torn write at the end is skipped by the readers
+        self.index.write(INDEX_ENTRY.pack(character_id, ms, status, len(data), self.size))
+        self.size += RECORD.size + len(data)
+
+    async def add(self, character_id: int, date, status: int, page: str):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.append, character_id, date, status, page)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.close_segment()
+
+
+def segments(directory: str) -> list:
+    return sorted(name[:-len('.pages')] for name in os.listdir(directory) if name.endswith('.pages'))
+
+
+def index_entries(directory: str, segment: str):
+    """(character id, ms, status, length, offset) of every complete record of a segment"""
+    path = os.path.join(directory, segment)
+    segment_size = os.path.getsize(f'{path}.pages')
+    with open(f'{path}.idx', 'rb') as index:
+        content = index.read()
+    for entry in INDEX_ENTRY.iter_unpack(content[:len(content) - len(content) % INDEX_ENTRY.size]):
+        if entry[4] + RECORD.size + entry[3] <= segment_size:
+            yield entry
+
+
+def records(directory: str, status: int = 200):
+    """(character id, ms, compressed page) of the records with the given status, oldest segment first"""
+    for segment in segments(directory):
+        with open(os.path.join(directory, f'{segment}.pages'), 'rb') as pages:
+            for character_id, ms, record_status, length, offset in index_entries(directory, segment):
+                if record_status == status:
+                    pages.seek(offset + RECORD.size)
+                    yield character_id, ms, pages.read(length)
+
+
+def find(directory: str, character_id: int):
+    """The last page archived of a character as (date, status, page), None if there's none"""
+    found = None
+    for segment in segments(directory):
+        for entry in index_entries(directory, segment):
+            if entry[0] == character_id:
+                found = segment, entry
+    if found is None:
+        return None
+    segment, (_, ms, status, length, offset) = found
+    with open(os.path.join(directory, f'{segment}.pages'), 'rb') as pages:
+        pages.seek(offset + RECORD.size)
+        return from_ms(ms), status, zlib.decompress(pages.read(length)).decode()
+
+
+def parse_compressed_in_worker(data: bytes):
+    """Runs in the replay workers, None for the pages the parser can't read"""
+    try:
+        return lodestone_parser.parse_in_worker(zlib.decompress(data).decode())
+    except Exception:
+        return None
+
+
+def replay_operations(chunk: list, parsed: list) -> list:
+    operations = []
+    for (character_id, ms, _), character in zip(chunk, parsed):
+        if character is None:
+            continue
+        date = from_ms(ms)
+        # Characters scrapped after the page was archived are left alone, the upsert fails on them instead
+        operations.append(UpdateOne(
+            {"_id": character_id, "scrapped_lodestone_date": {"$not": {"$gt": date}}},
+            {"$set": {**character, 'exists': True, 'scrapped_lodestone_date': date,
+                      'lodestone_fp': fingerprint(character, LODESTONE_FIELDS)}},
+            upsert=True))
+    return operations
+
+
+def replay(directory: str, workers: int = os.cpu_count(), parser: str = 'fast', chunk_size: int = 2000) -> tuple:
+    """
+        Parses every archived character page again in worker processes and bulk upserts the results.
+        The next chunk is being parsed while the previous one is written. Returns (written, unparseable).
+        The stats rollups don't see these writes, stats.rebuild() afterwards.
+    """
+    tables = metadata.get()
+    collection = MongoClient(utils.MONGO_URI)[utils.DATABASE][utils.CHARACTER_COLLECTION]
+    written, failed = 0, 0
+    source = records(directory)
+    with ProcessPoolExecutor(workers, initializer=lodestone_parser.init_worker,
+                             initargs=(parser, dict(tables.worlds), dict(tables.regions))) as executor:
+        def submit():
+            chunk = list(islice(source, chunk_size))
+            return chunk, executor.map(parse_compressed_in_worker, [_[2] for _ in chunk],
+                                       chunksize=max(len(chunk) // (workers * 4), 1))
+
+        chunk, parsing = submit()
+        while chunk:
+            parsed = list(parsing)
+            chunk_done = chunk
+            chunk, parsing = submit()
+            operations = replay_operations(chunk_done, parsed)
+            failed += len(chunk_done) - len(operations)
+            if not operations:
+                continue
+            try:
+                result = collection.bulk_write(operations, ordered=False)
+                written += result.modified_count + result.upserted_count
+            except BulkWriteError as e:
+                # Duplicate keys are the characters scrapped after the page was archived, the newer data wins
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+                written += e.details['nModified'] + e.details['nUpserted']
+    return written, failed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Reads the lodestone page archive')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='parse every archived page again and upsert the characters')
+    replay_parser.add_argument('directory')
+    replay_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    replay_parser.add_argument('--parser', default='fast', choices=list(lodestone_parser.PARSERS))
+    replay_parser.add_argument('--chunk-size', type=int, default=2000)
+    show_parser = commands.add_parser('show', help='print the last archived page of a character')
+    show_parser.add_argument('directory')
+    show_parser.add_argument('character_id', type=int)
+    args = arg_parser.parse_args()
+
+    if args.command == 'replay':
+        start = time.perf_counter()
+        written, failed = replay(args.directory, args.workers, args.parser, args.chunk_size)
+        print(f'{written} characters written, {failed} pages not parsed in {time.perf_counter() - start:.1f}s',
+              file=sys.stderr)
+    else:
+        found = find(args.directory, args.character_id)
+        if found is None:
+            sys.exit(f'no page archived for {args.character_id}')
+        date, status, page = found
+        print(f'{date} status {status}', file=sys.stderr)
+        print(page)
+
+
+if __name__ == '__main__':
+    main()
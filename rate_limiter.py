@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import time
+
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+
+def retry_after_seconds(value: str) -> float:
+    """Retry-After can be a number of seconds or an http date"""
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max((retry_date - datetime.now(retry_date.tzinfo)).total_seconds(), 0)
+
+
+class Stopped(Exception):
+    """Raised instead of waiting for a permit once the scraper is stopping"""
+
+
+async def pause(seconds: float, stopping: asyncio.Event = None):
+    """asyncio.sleep that raises Stopped as soon as stopping is set"""
+    if stopping is None:
+        return await asyncio.sleep(seconds)
+    try:
+        await asyncio.wait_for(stopping.wait(), seconds)
+    except asyncio.TimeoutError:
+        return
+    raise Stopped
+
+
+class AdaptiveRateLimiter:
+    """
+        Token bucket whose rate follows AIMD: every 200/404 adds increase/rate, so the rate grows by
+        about `increase` requests/sec each second, and a 429 multiplies it by `decrease`.
+        A Retry-After header pauses every permit until it has passed.
+
+            async with limiter:
+                async with session.get(url) as response:
+                    limiter.record(response.status, response.headers.get('Retry-After'))
+
+        A scraper waits through permit(stopping) instead, so a Retry-After pause doesn't hold up its shutdown.
+    """
+    def __init__(self, rate: float = 5.0, min_rate: float = 0.5, max_rate: float = 50.0, increase: float = 0.5,
+                 decrease: float = 0.5, max_in_flight: int = 100):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.lock = asyncio.Lock()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def __aenter__(self):
+        await self.in_flight.acquire()
+        try:
+            await self.acquire()
+        except BaseException:
+            self.in_flight.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight.release()
+
+    @contextlib.asynccontextmanager
+    async def permit(self, stopping: asyncio.Event = None):
+        """async with limiter, but raising Stopped instead of waiting once stopping is set"""
+        await self.in_flight.acquire()
+        try:
+            await self.acquire(stopping)
+            yield self
+        finally:
+            self.in_flight.release()
+
+    async def acquire(self, stopping: asyncio.Event = None):
+        # The lock keeps permits in arrival order
+        async with self.lock:
+            while True:
+                if stopping is not None and stopping.is_set():
+                    raise Stopped
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await pause(self.paused_until - now, stopping)
+                    continue
+                # Bursts are capped to a second worth of requests
+                self.tokens = min(self.tokens + (now - self.updated) * self.rate, max(self.rate, 1.0))
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await pause((1 - self.tokens) / self.rate, stopping)
+
+    def record(self, status: int, retry_after: str = None):
+        now = time.monotonic()
+        if status == 429:
+            # Requests already in flight will 429 too, only one decrease per rate interval
+            if now - self.last_decrease >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.tokens = min(self.tokens, 0)
+                self.last_decrease = now
+            pause = retry_after_seconds(retry_after)
+            if pause:
+                self.paused_until = max(self.paused_until, now + pause)
+        elif status in (200, 404):
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def stats(self) -> dict:
+        return {'rate': self.rate, 'paused_for': max(self.paused_until - time.monotonic(), 0)}
+
+
+_host_limiters = {}
+
+
+def for_host(host: str, rate: float = 5.0, max_rate: float = 50.0) -> AdaptiveRateLimiter:
+    """
+        The limiter of a host, shared by every scraper of the process that requests it. The first one to ask
+        sets the rate, the pages of a site count against the same limit whichever scraper asks for them.
+    """
+    if host not in _host_limiters:
+        _host_limiters[host] = AdaptiveRateLimiter(rate=rate, max_rate=max_rate)
+    return _host_limiters[host]
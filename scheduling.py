@@ -0,0 +1,28 @@
+import os
+
+from datetime import timedelta
+
+# Characters that change are checked again after BASE_INTERVAL, every scrape without changes doubles
+# the wait up to MAX_INTERVAL. Missing characters (404) back off on their own, slower, scale.
+BASE_INTERVAL = timedelta(hours=int(os.getenv("SCHEDULE_BASE_HOURS", 24)))
+MAX_INTERVAL = timedelta(days=int(os.getenv("SCHEDULE_MAX_DAYS", 60)))
+MISSING_BASE_INTERVAL = timedelta(days=int(os.getenv("SCHEDULE_MISSING_BASE_DAYS", 7)))
+MISSING_MAX_INTERVAL = timedelta(days=int(os.getenv("SCHEDULE_MISSING_MAX_DAYS", 180)))
+# Used when nothing is known about what changed, the old fixed window
+DEFAULT_INTERVAL = timedelta(days=3)
+
+
+def next_interval(previous: float, changed, exists, was_existing) -> timedelta:
+    """
+        previous is the last interval in seconds (None on the first scrape), changed the list of changed
+        fields (None when unknown), exists/was_existing tell if the character exists now and did before.
+    """
+    if exists is False:
+        if previous is None or was_existing is True:
+            return MISSING_BASE_INTERVAL
+        return min(timedelta(seconds=previous * 2), MISSING_MAX_INTERVAL)
+    if changed is None:
+        return DEFAULT_INTERVAL
+    if previous is None or changed or was_existing is False:
+        return BASE_INTERVAL
+    return min(timedelta(seconds=previous * 2), MAX_INTERVAL)
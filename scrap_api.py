@@ -1,80 +1,260 @@
 import asyncio
-from datetime import datetime, timedelta
-from fastapi import FastAPI
-from utils import DATABASE, MONGO_URI, CHARACTER_COLLECTION
-from pymongo import MongoClient
+import metadata
+import metrics
+import re
+import sys
+import traceback
+import uuid
+from change_detection import mode_fingerprint
+from datetime import datetime
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from utils import DATABASE, MONGO_URI, CHARACTER_COLLECTION, ENDGAME_METADATA, EPOCH, FRONTIER_ID, LEASE_TIME, \
+    FREE_COMPANY_COLLECTION, STATS_COLLECTION, FRONTIER_MAX_AGE, discover_frontier
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
 
 app = FastAPI()
 
 # Common variables for the API
-mongo_client = MongoClient(MONGO_URI)
+mongo_client = AsyncIOMotorClient(MONGO_URI)
 db = mongo_client[DATABASE]
-borrowed_indexes = {}
-indexes_lock = asyncio.Lock()
+# How many times a claim is retried when other API workers took our candidates first
+CLAIM_ATTEMPTS = 3
+# The frontier probe running in this API worker, if any
+frontier_probe = None
+
+
+@app.on_event("startup")
+async def create_indexes():
+    metrics.enable()
+    # The claim query only looks at the due date and hands out the oldest first, sharded claims also at the _id
+    await db[CHARACTER_COLLECTION].create_index([("lodestone_next", ASCENDING), ("_id", ASCENDING)])
+    await db[CHARACTER_COLLECTION].create_index([("exists", ASCENDING), ("fflogs_next", ASCENDING)])
+    await db[CHARACTER_COLLECTION].create_index([("exists", ASCENDING), ("fflogs_backfill_done", ASCENDING),
+                                                 ("fflogs_backfill_next", ASCENDING)])
+    await db[FREE_COMPANY_COLLECTION].create_index([("fc_next", ASCENDING)])
+
+
+async def shard_range(shard: int, shards: int) -> dict:
+    """
+        _id filter of a shard. The ids up to the frontier (or the highest stored id) are split in equal ranges,
+        the last shard has no upper bound so it's the one that grows. The ranges move a bit as the frontier
+        does, the leases keep two workers from claiming the same document meanwhile.
+    """
+    if shards is None or shards <= 1:
+        return {}
+    frontier = await db[ENDGAME_METADATA].find_one({"_id": FRONTIER_ID})
+    if frontier is None:
+        frontier = {'frontier': (await db[CHARACTER_COLLECTION].find_one({}, ['_id'], sort=[("_id", -1)]))['_id']}
+    size = frontier['frontier'] // shards + 1
+    bounds = {"$gte": shard * size + 1}
+    if shard < shards - 1:
+        bounds["$lt"] = (shard + 1) * size + 1
+    return {"_id": bounds}
+
+
+async def claim(collection, prefix: str, n_indexes: int, m_filter: dict = None, projection: list = None,
+                id_range: dict = None) -> list:
+    """
+        Leases up to n_indexes documents whose {prefix}_next date has passed, the longest overdue first.
+        The lease lives on the document itself, {prefix}_next is moved forward by LEASE_TIME so
+        if the scraper never reports back the document becomes claimable again on its own.
+        With m_filter only the matching documents are claimed, and documents without a due date count as due.
+        id_range restricts the claim to a shard, see shard_range.
+        Returns the ids, or the claimed documents when a projection is given.
+    """
+    due_field, lease_field = f'{prefix}_next', f'{prefix}_lease'
+    claimed = []
+    # a limit of 0 is no limit at all for mongo, it would lease every due document
+    if n_indexes <= 0:
+        return claimed
+    with metrics.STAGE_SECONDS.time('claim'):
+        for _ in range(CLAIM_ATTEMPTS):
+            now = datetime.now()
+            due = {due_field: {"$lte": now}} if m_filter is None else {**m_filter, due_field: {"$not": {"$gt": now}}}
+            due.update(id_range or {})
+            candidates = [item['_id'] async for item in
+                          collection.find(due, ['_id'], limit=n_indexes - len(claimed), sort=[(due_field, ASCENDING)])]
+            if not candidates:
+                break
+            token = uuid.uuid4().hex
+            # The due date is checked again, only the documents nobody claimed meanwhile get our token
+            await collection.update_many({"_id": {"$in": candidates}, **due},
+                                         {"$set": {due_field: now + LEASE_TIME, lease_field: token}})
+            claimed += [item if projection else item['_id'] async for item in
+                        collection.find({"_id": {"$in": candidates}, lease_field: token}, projection or ['_id'])]
+            if len(claimed) >= n_indexes:
+                break
+    metrics.CLAIMED.inc(prefix, amount=len(claimed))
+    return claimed
+
+
+async def probe_frontier():
+    try:
+        # discover_frontier uses the blocking mongo client, it gets a thread and an event loop of its own
+        frontier = await asyncio.to_thread(lambda: asyncio.run(discover_frontier()))
+        print(f'lodestone frontier at {frontier}', file=sys.stderr)
+    except Exception:
+        print(traceback.format_exc(), file=sys.stderr)
+
+
+async def refresh_frontier(frontier: dict):
+    """
+        Probes lodestone for a new frontier in the background when the stored one is older than FRONTIER_MAX_AGE,
+        the characters created since are queued once it's done. Only one API worker gets to move the date.
+    """
+    global frontier_probe
+    now = datetime.now()
+    if frontier_probe is not None and not frontier_probe.done():
+        return
+    if frontier.get('date') is not None and frontier['date'] > now - FRONTIER_MAX_AGE:
+        return
+    claimed = await db[ENDGAME_METADATA].update_one({"_id": FRONTIER_ID, "date": frontier.get('date')},
+                                                    {"$set": {"date": now}})
+    if claimed.modified_count:
+        frontier_probe = asyncio.create_task(probe_frontier())
 
 
 @app.get("/scraping/lodestone/{n_indexes}")
-async def lodestone(n_indexes: int):
-    """Returns the amount request of lodestone id to scrap"""
-    n_indexes = min(n_indexes, 100)
-    # Freeing the locked indexes
-    async with indexes_lock:
-        for lodestone_id, expire_time in borrowed_indexes.items():
-            if expire_time > datetime.now():
-                del borrowed_indexes[lodestone_id]
-        m_filter = {
-            "$and": [
-                {"$or": [{"exists": "S"}, {"exists": None}]},
-                {
-                    "$or": [
-                        {"scrapped_lodestone_date": None},
-                        {"scrapped_lodestone_date": {"$lt": datetime.now() - timedelta(days=3)}}
-                    ]
-                },
-                {"_id": {"$nin": list(borrowed_indexes.keys())}}
-            ]
-        }
-        print(f'Borrowed indexes {borrowed_indexes.keys()}')
-
-    cursor = db[CHARACTER_COLLECTION].find(m_filter, ['_id'], limit=n_indexes)
-    indexes = [item['_id'] for item in cursor]
-    if not indexes:
-        # we had 1000 more indexes to scrap
-        max_index = db[CHARACTER_COLLECTION].find_one({}, ['_id'], sort=[("_id", -1)])['_id']
-        indexes = [{"_id": i, "scrapped_lodestone_date": None,
-                    "scrapped_fflogs_date": None} for i in range(max_index+1, max_index+1001)]
-        db[CHARACTER_COLLECTION].insert_many(indexes)
-        indexes = [_['_id'] for _ in indexes][:n_indexes]
-    print(f'sending: {indexes}')
-    return {'lodestone_indexes': indexes}
+async def lodestone(n_indexes: int, shard: int = None, shards: int = None):
+    """Returns the amount request of lodestone id to scrap, only from the given shard when there's one"""
+    n_indexes = min(max(n_indexes, 1), 100)
+    projection = ['_id', 'lodestone_fp', 'lodestone_interval', 'exists']
+    id_range = await shard_range(shard, shards)
+    documents = await claim(db[CHARACTER_COLLECTION], 'lodestone', n_indexes, projection=projection, id_range=id_range)
+    if not documents and "$lt" not in id_range.get("_id", {}):
+        # we had 1000 more indexes to scrap, but never past the last live character utils.discover_frontier found.
+        # New ids belong to the last shard, it's the only one that adds them
+        max_index = (await db[CHARACTER_COLLECTION].find_one({}, ['_id'], sort=[("_id", -1)]))['_id']
+        frontier = await db[ENDGAME_METADATA].find_one({"_id": FRONTIER_ID})
+        top_index = max_index + 1001 if frontier is None else min(max_index + 1001, frontier['frontier'] + 1)
+        if top_index <= max_index + 1:
+            await refresh_frontier(frontier)
+            return {'lodestone_indexes': []}
+        new_documents = [{"_id": i, "scrapped_lodestone_date": None, "scrapped_fflogs_date": None,
+                          "lodestone_next": EPOCH} for i in range(max_index+1, top_index)]
+        # Another API worker may have inserted the same range already
+        try:
+            await db[CHARACTER_COLLECTION].insert_many(new_documents, ordered=False)
+        except BulkWriteError:
+            pass
+        documents = await claim(db[CHARACTER_COLLECTION], 'lodestone', n_indexes, projection=projection,
+                                id_range=id_range)
+    # The fingerprints of the last scrape let the scrapers write only what changed,
+    # the last interval and exists flag are what the next scrape is scheduled from
+    return {'lodestone_indexes': [_['_id'] for _ in documents],
+            'fingerprints': {str(_['_id']): _['lodestone_fp'] for _ in documents if 'lodestone_fp' in _},
+            'schedule': {str(_['_id']): {'interval': _.get('lodestone_interval'), 'exists': _.get('exists')}
+                         for _ in documents if 'lodestone_interval' in _ or 'exists' in _}}
 
 
 @app.get("/scraping/fflogs/{n_indexes}")
-async def fflogs(n_indexes: int):
+async def fflogs(n_indexes: int, mode: str = 'simple', shard: int = None, shards: int = None):
     """
         Returns the amount indicated of characters to query the FFLOGS API.
         It can return the fflogs_id or the character name with its server
         if it wasn't matched the lodestone_id to the fflogs_id yet.
+        The characters are leased, the ones never queried first, then the most overdue.
+        In old_fights mode they come with the zones already backfilled.
+        With shard and shards only the characters of that shard are handed out.
     """
-    # TODO: Support different types of fflogs queries, give indexes with no information first then
-    #  give it to old information, for each type of query
-
-    m_filter = {"$and": [
-        {"exists": "S"},
-        {"$or": [
-            {"scrapped_fflogs_date": None},
-            {"scrapped_fflogs_date": {"$lt": datetime.now() - timedelta(days=3)}}]}
-        ]
-    }
-
-    cursor = db[CHARACTER_COLLECTION].find(m_filter, ['_id', 'fflogs_id', 'name', 'server', 'region'], limit=n_indexes)
+    n_indexes = min(max(n_indexes, 1), 100)
+    id_range = await shard_range(shard, shards)
+    fields = ['_id', 'fflogs_id', 'name', 'server', 'region', 'fflogs_fp']
+    if mode == 'old_fights':
+        # $in gives point bounds on the middle key of the index, mongo merges them in fflogs_backfill_next order.
+        # $ne would be two ranges and a blocking sort of every character not backfilled yet
+        items = await claim(db[CHARACTER_COLLECTION], 'fflogs_backfill', n_indexes,
+                            {"exists": True, "fflogs_backfill_done": {"$in": [None, False]}},
+                            fields + ['zone_rankings_done'], id_range)
+    else:
+        # the lodestone scraper stores exists as a boolean
+        items = await claim(db[CHARACTER_COLLECTION], 'fflogs', n_indexes, {"exists": True},
+                            fields + ['fflogs_interval'], id_range)
 
     response = {'fflogs_id': [], 'character_data': []}
-    for item in cursor:
+    for item in items:
         item_keys = item.keys()
+        tmp = {'_id': item['_id'], 'fingerprint': mode_fingerprint(item.get('fflogs_fp'), mode)}
+        if mode == 'old_fights':
+            tmp['zones_done'] = item.get('zone_rankings_done', [])
+        else:
+            tmp['interval'] = item.get('fflogs_interval')
         if 'fflogs_id' in item_keys:
-            response['fflogs_id'].append(item['fflogs_id'])
+            tmp['fflogs_id'] = item['fflogs_id']
+            response['fflogs_id'].append(tmp)
         elif 'name' in item_keys and 'server' in item_keys and 'region' in item_keys:
-            tmp = {'name': item['name'], 'server': item['server'], 'region': item['region']}
+            tmp.update({'name': item['name'], 'server': item['server'], 'region': item['region']})
             response['character_data'].append(tmp)
     return response
+
+
+@app.get("/scraping/freecompany/{n_indexes}")
+async def free_company(n_indexes: int):
+    """
+        Leases the free companies whose member list is due, utils.seed_free_companies fills the queue.
+        They come with the members seen last time so the scraper can tell who left.
+    """
+    n_indexes = min(max(n_indexes, 1), 100)
+    items = await claim(db[FREE_COMPANY_COLLECTION], 'fc', n_indexes,
+                        projection=['_id', 'members', 'fc_interval', 'exists'])
+    return {'free_companies': [{'_id': item['_id'], 'members': item.get('members', []),
+                                'interval': item.get('fc_interval'), 'exists': item.get('exists')} for item in items]}
+
+
+@app.get("/stats/jobs/{scope}")
+async def job_stats_keys(scope: str):
+    """Servers, datacenters or regions with job statistics, and how many characters each has"""
+    cursor = db[STATS_COLLECTION].find({"_id": {"$regex": f"^jobs:{re.escape(scope)}:"}}, ['characters'])
+    return {item['_id'].split(':', 2)[2]: item.get('characters', 0) async for item in cursor}
+
+
+@app.get("/stats/jobs/{scope}/{key}")
+async def job_stats(scope: str, key: str):
+    """
+        Level distribution of every job, level -> characters, and how many characters have it capped.
+        scope is all (with key all), server, datacenter or region. Rollups kept by stats.Rollups, a single read.
+    """
+    item = await db[STATS_COLLECTION].find_one({"_id": f"jobs:{scope}:{key}"})
+    if item is None:
+        raise HTTPException(status_code=404, detail=f"No job statistics for {scope} {key}")
+    return {'characters': item.get('characters', 0), 'levels': item.get('levels', {}),
+            'capped': item.get('capped', {})}
+
+
+@app.get("/stats/rankings")
+async def ranking_stats_encounters():
+    """Encounters with ranking statistics, with their name and how many characters killed them"""
+    cursor = db[STATS_COLLECTION].find({"_id": {"$regex": "^rankings:"}}, ['name', 'characters'])
+    return {item['_id'].split(':', 1)[1]: {'name': item.get('name'), 'characters': item.get('characters', 0)}
+            async for item in cursor}
+
+
+@app.get("/stats/rankings/{encounter_id}")
+async def ranking_stats(encounter_id: str):
+    """Histogram of the best percentile of every character that killed the encounter, and the jobs they used"""
+    item = await db[STATS_COLLECTION].find_one({"_id": f"rankings:{encounter_id}"})
+    if item is None:
+        raise HTTPException(status_code=404, detail=f"No ranking statistics for encounter {encounter_id}")
+    return {'name': item.get('name'), 'characters': item.get('characters', 0),
+            'best_percent': item.get('best_percent', {}), 'best_job': item.get('best_job', {})}
+
+
+@app.get("/metadata")
+async def metadata_tables():
+    """Servers, zones and encounters, reloaded only when metadata.save bumped the version"""
+    tables = await metadata.async_refresh(db)
+    return {'version': tables.version, 'servers': {slug: dict(server) for slug, server in tables.servers.items()},
+            'zones': dict(tables.zones), 'encounters': dict(tables.encounters)}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus text format, leases are the documents whose due date is within the lease time"""
+    now = datetime.now()
+    leases = await db[CHARACTER_COLLECTION].count_documents(
+        {"lodestone_next": {"$gt": now, "$lte": now + LEASE_TIME}})
+    metrics.LEASES.set_function(lambda: leases, 'lodestone')
+    return metrics.render()
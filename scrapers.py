@@ -1,245 +1,741 @@
 import asyncio
 import aiohttp
-import requests
+import change_detection
 import utils
 import fflogs_utils
+import inspect
+import journal
+import lodestone_parser
+import metadata
+import metrics
+import os
+import page_archive
+import rate_limiter
+import scheduling
+import signal
+import stats
 import sys
+import time
 import traceback
 
-from bs4 import BeautifulSoup
-from pymongo import MongoClient, UpdateOne
+from motor.motor_asyncio import AsyncIOMotorClient
+from fflogs_budget import PointBudget
+from mongo_writer import BulkWriter
+from rate_limiter import Stopped
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
-character_index_api = 'http://127.0.0.1:8000/scraping/lodestone/{}'
-fflogs_index_api = 'http://127.0.0.1:8000/scraping/fflogs/{}'
+character_index_api = utils.INDEX_API_URL + '/scraping/lodestone/{}'
+fflogs_index_api = utils.INDEX_API_URL + '/scraping/fflogs/{}'
+free_company_index_api = utils.INDEX_API_URL + '/scraping/freecompany/{}'
+TOKEN_MARGIN = timedelta(minutes=5)
+# How long a scraper waits before asking the API again when it had nothing to hand out
+IDLE_WAIT = 10
+
+
+async def idle(stopping: asyncio.Event, seconds: float = IDLE_WAIT):
+    """Sleeps, unless the scraper is told to stop meanwhile"""
+    try:
+        await asyncio.wait_for(stopping.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def fresh_metadata(current: metadata.Metadata, db, force: bool = False) -> metadata.Metadata:
+    """
+        The metadata of the last version, checked every metadata.REFRESH_INTERVAL seconds or right away with force.
+        A scraper keeps what it has while mongo can't be reached.
+    """
+    try:
+        return await metadata.async_refresh(db, 0 if force else metadata.REFRESH_INTERVAL)
+    except PyMongoError:
+        return current
+
+
+def open_journal(journal_dir: str, name: str) -> journal.Journal:
+    """One file per worker, workers sharing a journal would take each other's ids and writes"""
+    return journal.Journal(os.path.join(journal_dir, f'{name}.sqlite') if journal_dir else ':memory:')
 
 
 class LodestoneScraper:
-    def __init__(self, session, batch_size=10, delay=2):
+    def __init__(self, session, batch_size=10, rate=5.0, max_rate=50.0, parser='fast',
+                 parse_workers=utils.PARSE_WORKERS, parse_backlog=None,
+                 flush_size=utils.WRITE_FLUSH_SIZE, flush_interval=utils.WRITE_FLUSH_INTERVAL, metrics_port=None,
+                 change_detection=True, change_log=False, shard=None, shards=None, rollups=True,
+                 archive_dir=utils.PAGE_ARCHIVE_DIR, journal_dir=utils.JOURNAL_DIR, max_attempts=utils.MAX_ATTEMPTS):
         self.session = session
-        self.delay = delay
-        self.mongo_client = MongoClient(utils.MONGO_URI)
-        self.db = self.mongo_client[utils.DATABASE]
-        self.raids = self.db[utils.ENDGAME_METADATA].find_one({"raids": {"$exists": True}})['raids']
-        self.worlds = self.db[utils.ENDGAME_METADATA].find_one({'regions': {'$exists': True}})['regions']
-        self.worlds = {key: value for key, value in self.worlds.items() if value['slug'] in ['EU', 'NA', 'JP', 'OC']}
-        normalization = {}
-        self.regions = {}
-        for key, tmp in self.worlds.items():
-            slug = tmp['slug']
-            for _, item in tmp['servers'].items():
-                normalization[item['name']] = item['slug']
-                self.regions[item['slug']] = slug
-        self.worlds = normalization
+        # Raw pages go to the archive instead of the documents, page_archive.py can parse them again
+        self.archive = page_archive.PageArchive(archive_dir) if archive_dir else None
+        # Only the ids of this shard are claimed, see scrap_api.shard_range
+        self.index_params = {'shard': shard, 'shards': shards} if shards else {}
+        # Set by stop(), the batch in hand is finished and the writes flushed before scrap returns
+        self.stopping = asyncio.Event()
+        # Only write the fields whose fingerprint changed, optionally keeping a log of the changes
+        self.change_detection = change_detection
+        self.change_log = change_log
+        # lodestone id -> fingerprint stored by the previous scrape, as handed out by the API
+        self.fingerprints = {}
+        # lodestone id -> last interval and exists flag, the next scrape is scheduled from them
+        self.schedule = {}
+        # Requests are paced by the limiter, the batch size only sets how many ids are claimed at once.
+        # It's shared with the free company scraper of the same process
+        self.limiter = rate_limiter.for_host(urlparse(utils.LODESTONE_URL).netloc, rate, max_rate)
+        self.metadata = metadata.get()
+        self.parser_backend = parser
+        self.parser = lodestone_parser.PARSERS[parser](self.metadata.worlds, self.metadata.regions)
+        # The worker processes get plain copies of the tables
+        self.parse_pool = lodestone_parser.ParserPool(parser, dict(self.metadata.worlds), dict(self.metadata.regions),
+                                                      parse_workers, parse_backlog) if parse_workers else None
         self.batch_size = batch_size
-        self.err_list = []
-        self.err_lock = asyncio.Lock()
-        self.update_op_list = []
+        self.max_attempts = max_attempts
+        # Claimed ids, retries and unflushed writes, a restarted worker carries on from them
+        self.journal = open_journal(journal_dir, f'lodestone-{shard or 0}')
+        for character_id, (fingerprint, state) in self.journal.claimed().items():
+            if fingerprint is not None:
+                self.fingerprints[character_id] = fingerprint
+            if state is not None:
+                self.schedule[character_id] = state
+        # Ids of the batch in hand, they count a failed attempt if the batch raises
+        self.in_flight = []
+        self.writer = BulkWriter(AsyncIOMotorClient(utils.MONGO_URI)[utils.DATABASE][utils.CHARACTER_COLLECTION],
+                                 flush_size=flush_size, flush_interval=flush_interval, journal=self.journal)
+        # Job statistics are updated from every batch, see stats.Rollups
+        self.stats_writer = BulkWriter(self.writer.collection.database[utils.STATS_COLLECTION],
+                                       flush_size=flush_size, flush_interval=flush_interval, journal=self.journal)
+        self.rollups = stats.Rollups(self.writer.collection, self.stats_writer, stats.job_contribution,
+                                     stats.JOB_FIELDS, {"exists": True}) if rollups else None
         self.lock = asyncio.Lock()
+        self.metrics_port = metrics_port
+        metrics.QUEUE_DEPTH.set_function(self.writer.queue.qsize, 'lodestone_writes')
+        metrics.QUEUE_DEPTH.set_function(self.journal.retries, 'lodestone_retries')
+        metrics.LODESTONE_RATE.set_function(lambda: self.limiter.rate)
+
+    def stop(self):
+        self.stopping.set()
+
+    async def refresh_metadata(self, force: bool = False):
+        loaded = await fresh_metadata(self.metadata, self.writer.collection.database, force)
+        if loaded.version == self.metadata.version:
+            return
+        self.metadata = loaded
+        self.parser = lodestone_parser.PARSERS[self.parser_backend](loaded.worlds, loaded.regions)
+        if self.parse_pool:
+            self.parse_pool.reload(dict(loaded.worlds), dict(loaded.regions))
 
     async def scrap(self):
         try:
-            delay_flag = True
-            while True:
-                batch_size = 0 if len(self.err_list) >= self.batch_size else self.batch_size-len(self.err_list)
-                # prepare the tasks
-                async with self.session.get(character_index_api.format(batch_size)) as response:
-                    data = await response.json()
-                    indexes_to_scrap = \
-                        data['lodestone_indexes'] if not self.err_list else self.err_list + data['lodestone_indexes']
-                    self.err_list = []
-                    tasks = [asyncio.create_task(self.get_character(_)) for _ in indexes_to_scrap]
-                    for character, error in await asyncio.gather(*tasks):
-                        if error and character not in self.err_list:
-                            self.err_list.append(character['_id'])
-                            delay_flag = True
-                        else:
-                            update = UpdateOne({"_id": character["_id"]}, {"$set": character}, upsert=True)
-                            self.update_op_list.append(update)
-
-                if self.update_op_list:
-                    self.db[utils.CHARACTER_COLLECTION].bulk_write(self.update_op_list)
-                    self.update_op_list = []
-
-                if delay_flag:
-                    await asyncio.sleep(self.delay)
-                    delay_flag = False
-
-        except Exception:
-            print(traceback.format_exc(), file=sys.stderr)
+            if self.metrics_port:
+                await metrics.start_server(self.metrics_port)
+            self.writer.start()
+            self.stats_writer.start()
+            while not self.stopping.is_set():
+                try:
+                    await self.refresh_metadata()
+                    await self.scrap_batch()
+                except Exception:
+                    if self.writer.error or self.stats_writer.error:
+                        # Mongo is gone, everything not written is in the journal for the restarted worker
+                        raise
+                    # The batch is retried from the journal, the worker only stops when it's told to
+                    print(traceback.format_exc(), file=sys.stderr)
+                    self.give_up(self.journal.failed(self.in_flight, self.max_attempts))
+                    await idle(self.stopping)
         finally:
+            await self.writer.close()
+            await self.stats_writer.close()
             await self.session.close()
+            if self.parse_pool:
+                self.parse_pool.close()
+            if self.archive:
+                self.archive.close()
+            self.journal.close()
+
+    async def scrap_batch(self):
+        self.in_flight = []
+        # What's left in the journal goes first: the retries, and after a crash the batch that was in hand
+        retries = self.journal.claimed_ids()
+        retried = set(retries)
+        data = {'lodestone_indexes': []}
+        # A batch full of retries doesn't ask for more, the API can't hand out 0 ids
+        if len(retries) < self.batch_size:
+            async with self.session.get(character_index_api.format(self.batch_size - len(retries)),
+                                        params=self.index_params) as response:
+                data = await response.json()
+        fingerprints = {int(key): value for key, value in data.get('fingerprints', {}).items()}
+        schedule = {int(key): value for key, value in data.get('schedule', {}).items()}
+        self.journal.claim(data['lodestone_indexes'], fingerprints, schedule)
+        self.fingerprints.update(fingerprints)
+        self.schedule.update(schedule)
+        self.in_flight = retries + [_ for _ in data['lodestone_indexes'] if _ not in retried]
+        if not self.in_flight:
+            await idle(self.stopping)
+            return
+
+        tasks = [asyncio.create_task(self.get_character(_)) for _ in self.in_flight]
+        scrapped, failed = [], []
+        for character_id, result in zip(self.in_flight, await asyncio.gather(*tasks, return_exceptions=True)):
+            if isinstance(result, Stopped):
+                # Never requested, it stays in the journal for the next run without counting as an attempt
+                continue
+            if isinstance(result, Exception):
+                print(f'Character {character_id} failed: {result!r}', file=sys.stderr)
+                failed.append(character_id)
+            elif result[1]:
+                failed.append(character_id)
+            else:
+                scrapped.append(result[0])
+        for update in await self.character_updates(scrapped):
+            await self.writer.put(update)
+        # Committed along with the writes of the batch
+        self.journal.done([_['_id'] for _ in scrapped])
+        self.give_up(self.journal.failed(failed, self.max_attempts))
+        self.in_flight = []
+
+    def give_up(self, character_ids: list):
+        for character_id in character_ids:
+            self.fingerprints.pop(character_id, None)
+            self.schedule.pop(character_id, None)
+        if character_ids:
+            print(f'Giving up on {len(character_ids)} characters after {self.max_attempts} attempts', file=sys.stderr)
 
     async def get_character(self, character_id: int = None) -> tuple:
         character_info = {'_id': character_id}
         error = False
-        url = f'https://eu.finalfantasyxiv.com/lodestone/character/{character_id}/'
-        async with self.session.get(url) as response:
-            if response.status == 200:
-                character_page = await response.text()
-                character_info = {**character_info, **self.get_character_info(character_page),
-                                  'exists': True, 'scrapped_lodestone_date': datetime.now()}
-            elif response.status == 404:
-                character_info['exists'] = False
-            # Lodestone returns 429 if there's too many request from a single endpoint
-            elif response.status == 429:
-                error = True
-            else:
-                # Even though this is an error it's worth saving the info since it could be interesting
-                character_info['error'] = response.status
-                character_info['webpage'] = await response.text()
-                print(f'There was an error with character {character_id}')
+        url = utils.LODESTONE_CHARACTER_URL.format(character_id)
+        async with self.limiter.permit(self.stopping):
+            start = time.perf_counter()
+            async with self.session.get(url) as response:
+                metrics.STAGE_SECONDS.observe('http_fetch', value=time.perf_counter() - start)
+                metrics.RESPONSES.inc('lodestone', metrics.status_label(response.status))
+                self.limiter.record(response.status, response.headers.get('Retry-After'))
+                if response.status == 200:
+                    if self.parse_pool:
+                        # Waiting for a slot before reading the body keeps the pages in memory bounded
+                        async with self.parse_pool.slots:
+                            page = await response.text()
+                            parsed = await self.parse_page(page)
+                    else:
+                        page = await response.text()
+                        parsed = await self.parse_page(page)
+                    # Same date in the archive and the document, a replay won't overwrite a newer scrape
+                    now = datetime.now()
+                    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+                    if self.archive:
+                        await self.archive.add(character_id, now, response.status, page)
+                    character_info = {**character_info, **parsed, 'exists': True, 'scrapped_lodestone_date': now}
+                elif response.status == 404:
+                    # Checked again with a backoff, it may be a character that's not created yet
+                    character_info['exists'] = False
+                # Lodestone returns 429 if there's too many request from a single endpoint
+                elif response.status == 429:
+                    error = True
+                else:
+                    # Even though this is an error it's worth saving the info since it could be interesting
+                    character_info['error'] = response.status
+                    if self.archive:
+                        await self.archive.add(character_id, datetime.now(), response.status, await response.text())
+                    else:
+                        character_info['webpage'] = await response.text()
+                    print(f'There was an error with character {character_id}')
 
-            return character_info, error
+                return character_info, error
+
+    async def parse_page(self, page: str) -> dict:
+        version = self.metadata.version
+        try:
+            with metrics.STAGE_SECONDS.time('html_parse'):
+                return await self.parse_pool.parse(page) if self.parse_pool else self.get_character_info(page)
+        except KeyError:
+            # Most likely a world added since the metadata was loaded, parsed again if there's a newer version
+            await self.refresh_metadata(force=True)
+            if self.metadata.version == version:
+                raise
+        return await self.parse_pool.parse(page) if self.parse_pool else self.get_character_info(page)
 
     def get_character_info(self, character_page: str) -> dict:
-        tmp = {}
-        soup = BeautifulSoup(character_page, 'html.parser')
-        tmp['name'] = soup.find('p', class_='frame__chara__name').text
-        title_tag = soup.find('p', class_='frame__chara__title')
-        if title_tag:
-            tmp['title'] = soup.find('p', class_='frame__chara__title').text
-        world_dc = soup.find('p', class_='frame__chara__world').text
-        tmp['server'], tmp['datacenter'] = world_dc.split(' ')
-        tmp['datacenter'] = tmp['datacenter'].replace('[', '').replace(']', '')
-        tmp['server'] = self.worlds[tmp['server']]
-        tmp['region'] = self.regions[tmp['server']]
-        # Not all characters are in a free company
+        return self.parser.parse(character_page)
+
+    async def character_updates(self, characters: list) -> list:
+        """
+            Turns the scrapped characters into UpdateOne operations and schedules their next scrape.
+            With change detection the fingerprinted fields are only written when they changed; the change log
+            needs the old jobs of the characters whose jobs changed, those are read in a single query.
+        """
+        now = datetime.now()
+        updates = []
+        for character in characters:
+            old_fingerprint = self.fingerprints.pop(character['_id'], None)
+            state = self.schedule.pop(character['_id'], {})
+            if self.change_detection and character.get('exists'):
+                update, changed = change_detection.minimal_update(character, old_fingerprint,
+                                                                  change_detection.LODESTONE_FIELDS, 'lodestone_fp')
+            else:
+                # Without fingerprints there's no telling what changed, it gets the fixed interval
+                update, changed = {"$set": dict(character)}, None
+            interval = scheduling.next_interval(state.get('interval'), changed, character.get('exists'),
+                                                state.get('exists'))
+            update["$set"].update({'lodestone_next': now + interval, 'lodestone_interval': interval.total_seconds()})
+            if state.get('exists') and character.get('exists') is False:
+                # A 404 leaves the scrape date alone, this is what an incremental export finds it by
+                update["$set"]['lodestone_missing_date'] = now
+            if old_fingerprint is not None and changed and 'jobs' in changed:
+                # A levelling character is likely clearing content too
+                update["$min"] = {'fflogs_next': now}
+            if changed is not None and state.get('exists') is not None and state['exists'] != character.get('exists'):
+                # Back from a 404 with the same fingerprint, the rollups still have to count it in again
+                rollup_changed = changed + ['exists']
+            else:
+                rollup_changed = changed
+            updates.append((character, update, changed, old_fingerprint, rollup_changed))
+
+        old_jobs = {}
+        jobs_changed = [_[0]['_id'] for _ in updates if _[3] is not None and _[2] and 'jobs' in _[2]]
+        if self.change_log and jobs_changed:
+            cursor = self.writer.collection.find({"_id": {"$in": jobs_changed}}, ['jobs'])
+            old_jobs = {item['_id']: item.get('jobs', {}) async for item in cursor}
+
+        operations = []
+        for character, update, changed, old_fingerprint, _ in updates:
+            if self.change_log and old_fingerprint is not None and changed:
+                entry = {'date': character['scrapped_lodestone_date'], 'fields': changed}
+                if character['_id'] in old_jobs:
+                    entry['jobs_gained'] = change_detection.jobs_gained(old_jobs[character['_id']], character['jobs'])
+                change_detection.add_change_log(update, 'lodestone_changes', entry)
+            operations.append(UpdateOne({"_id": character["_id"]}, update, upsert=True))
+        if self.rollups:
+            # An error page says nothing about the character, it's not counted out
+            await self.rollups.update([(character, rollup_changed) for character, _, _, _, rollup_changed in updates
+                                       if 'error' not in character])
+        return operations
+
+
+class FreeCompanyScraper:
+    """
+        Refreshes characters in bulk from the free company member lists, a page lists up to 50 of them.
+        The members are compared against the fingerprints of their last character scrape, only the ones
+        that are new, changed name, world or free company, or left, are queued for a full scrape.
+    """
+    def __init__(self, session, batch_size=5, rate=5.0, max_rate=50.0,
+                 flush_size=utils.WRITE_FLUSH_SIZE, flush_interval=utils.WRITE_FLUSH_INTERVAL, metrics_port=None,
+                 journal_dir=utils.JOURNAL_DIR, worker=0):
+        self.session = session
+        self.batch_size = batch_size
+        self.stopping = asyncio.Event()
+        # Same host as LodestoneScraper, in the same process both go through one limiter
+        self.limiter = rate_limiter.for_host(urlparse(utils.LODESTONE_URL).netloc, rate, max_rate)
+        self.metadata = metadata.get()
+        self.parser = lodestone_parser.RosterParser(self.metadata.worlds, self.metadata.regions)
+        db = AsyncIOMotorClient(utils.MONGO_URI)[utils.DATABASE]
+        self.characters = db[utils.CHARACTER_COLLECTION]
+        # Free company workers aren't sharded, the journal is named after the worker
+        self.journal = open_journal(journal_dir, f'freecompany-{worker}')
+        self.writer = BulkWriter(self.characters, flush_size=flush_size, flush_interval=flush_interval,
+                                 journal=self.journal)
+        self.fc_writer = BulkWriter(db[utils.FREE_COMPANY_COLLECTION], flush_size=flush_size,
+                                    flush_interval=flush_interval, journal=self.journal)
+        self.metrics_port = metrics_port
+        metrics.QUEUE_DEPTH.set_function(self.writer.queue.qsize, 'roster_writes')
+
+    def stop(self):
+        self.stopping.set()
+
+    async def refresh_metadata(self, force: bool = False):
+        loaded = await fresh_metadata(self.metadata, self.characters.database, force)
+        if loaded.version != self.metadata.version:
+            self.metadata = loaded
+            self.parser = lodestone_parser.RosterParser(loaded.worlds, loaded.regions)
+
+    async def scrap(self):
         try:
-            a_tag = soup.find('div', class_='character__freecompany__name').find('a')
-            # -2 due to the / at the end of the url
-            tmp['fc_id'] = a_tag.get('href').split('/')[-2]
-        except AttributeError:
-            tmp['fc_id'] = None
-
-        # TODO: Normalize classes/jobs names
-        tmp['jobs'] = {
-            li.img.get('data-tooltip').replace(' (Limited Job)', '').split(' / ')[0]:
-                0 if li.text == '-' else int(li.text)
-            for li in [x for y in soup.find_all('div', class_='character__level__list') for x in y.find_all('li')]
-        }
+            if self.metrics_port:
+                await metrics.start_server(self.metrics_port)
+            self.writer.start()
+            self.fc_writer.start()
+            while not self.stopping.is_set():
+                try:
+                    await self.refresh_metadata()
+                    await self.scrap_batch()
+                except Exception:
+                    if self.writer.error or self.fc_writer.error:
+                        # Mongo is gone, everything not written is in the journal for the restarted worker
+                        raise
+                    # The free companies of the batch are handed out again once their leases run out
+                    print(traceback.format_exc(), file=sys.stderr)
+                    await idle(self.stopping)
 
-        return tmp
+        except Exception:
+            print(traceback.format_exc(), file=sys.stderr)
+        finally:
+            await self.writer.close()
+            await self.fc_writer.close()
+            await self.session.close()
+            self.journal.close()
+
+    async def scrap_batch(self):
+        async with self.session.get(free_company_index_api.format(self.batch_size)) as response:
+            free_companies = (await response.json())['free_companies']
+        if not free_companies:
+            # Nothing due, utils.seed_free_companies adds the free companies found since
+            await idle(self.stopping, 60)
+            return
+        results = await asyncio.gather(*[self.scrap_free_company(_) for _ in free_companies], return_exceptions=True)
+        for free_company, result in zip(free_companies, results):
+            # Left leased like a failed page, it's handed out again once the lease runs out
+            if isinstance(result, Exception) and not isinstance(result, Stopped):
+                print(f'Free company {free_company["_id"]} failed: {result!r}', file=sys.stderr)
+        self.journal.commit()
+
+    async def get_page(self, fc_id: str, page: int) -> tuple:
+        async with self.limiter.permit(self.stopping):
+            start = time.perf_counter()
+            url = utils.LODESTONE_FC_MEMBERS_URL.format(fc_id)
+            async with self.session.get(url, params={'page': page}) as response:
+                metrics.STAGE_SECONDS.observe('http_fetch', value=time.perf_counter() - start)
+                metrics.RESPONSES.inc('lodestone_fc', metrics.status_label(response.status))
+                self.limiter.record(response.status, response.headers.get('Retry-After'))
+                return response.status, await response.text() if response.status == 200 else None
+
+    async def parse_page(self, page: str) -> dict:
+        version = self.metadata.version
+        try:
+            with metrics.STAGE_SECONDS.time('html_parse'):
+                return self.parser.parse(page)
+        except KeyError:
+            # A world added since the metadata was loaded
+            await self.refresh_metadata(force=True)
+            if self.metadata.version == version:
+                raise
+        return self.parser.parse(page)
+
+    async def scrap_free_company(self, free_company: dict):
+        status, page = await self.get_page(free_company['_id'], 1)
+        if status == 404:
+            return await self.roster_updates(free_company, None)
+        if status != 200:
+            # Left leased, it's handed out again once the lease runs out
+            return
+        parsed = await self.parse_page(page)
+        members = parsed['members']
+        for status, page in await asyncio.gather(*[self.get_page(free_company['_id'], _)
+                                                   for _ in range(2, parsed['pages'] + 1)]):
+            if status != 200:
+                # A partial list would look like members leaving
+                return
+            members += (await self.parse_page(page))['members']
+        await self.roster_updates(free_company, members)
+
+    async def roster_updates(self, free_company: dict, members):
+        """Queues the changed members for a full scrape and schedules the next visit, members is None if it's gone"""
+        now = datetime.now()
+        fc_id = free_company['_id']
+        ids = [_['_id'] for _ in members or []]
+        fingerprints = {}
+        if ids:
+            cursor = self.characters.find({"_id": {"$in": ids}}, ['lodestone_fp'])
+            fingerprints = {item['_id']: item.get('lodestone_fp') async for item in cursor}
+
+        changed = []
+        for member in members or []:
+            member['fc_id'] = fc_id
+            old_fingerprint = fingerprints.get(member['_id'])
+            roster_fingerprint = change_detection.fingerprint(member, change_detection.ROSTER_FIELDS)
+            update = {"$set": {'fc_rank': member['fc_rank'], 'fc_roster_date': now},
+                      "$setOnInsert": {"scrapped_lodestone_date": None, "scrapped_fflogs_date": None}}
+            if old_fingerprint is None or \
+                    any(old_fingerprint.get(field) != value for field, value in roster_fingerprint.items()):
+                update["$min"] = {'lodestone_next': now}
+                changed.append(member['_id'])
+            await self.writer.put(UpdateOne({"_id": member['_id']}, update, upsert=True))
+        metrics.ROSTER_MEMBERS.inc('unchanged', amount=len(ids) - len(changed))
+        metrics.ROSTER_MEMBERS.inc('queued', amount=len(changed))
+
+        # Whoever left has a new free company, or none
+        left = set(free_company['members']) - set(ids)
+        for character_id in left:
+            await self.writer.put(UpdateOne({"_id": character_id}, {"$min": {'lodestone_next': now}}))
+        metrics.ROSTER_MEMBERS.inc('left', amount=len(left))
+
+        exists = members is not None
+        interval = scheduling.next_interval(free_company['interval'], changed + list(left), exists,
+                                            free_company['exists'])
+        await self.fc_writer.put(UpdateOne({"_id": fc_id}, {"$set": {
+            'exists': exists, 'members': ids, 'member_count': len(ids), 'scrapped_date': now,
+            'fc_next': now + interval, 'fc_interval': interval.total_seconds()}}))
 
 
 class FFlogsScraper:
     """This class scraps FFlogs.com then dumps it into a mongodb collection."""
     # TODO: Rewrite queries using gql
-    def __init__(self, session, batch_size=10, mode='simple', **kwargs):
-        self.wait_more_points = False
-        self.token_points = None
-        self.time_til_points = None
-        self.token_points_left = None
+    def __init__(self, session, batch_size=10, mode='simple', batch_width=10, zones_per_query=5,
+                 flush_size=utils.WRITE_FLUSH_SIZE, flush_interval=utils.WRITE_FLUSH_INTERVAL, metrics_port=None,
+                 change_detection=True, change_log=False, shard=None, shards=None, rollups=True,
+                 journal_dir=utils.JOURNAL_DIR, **kwargs):
         self.time_to_new_token = None
+        self.index_params = {'mode': mode, **({'shard': shard, 'shards': shards} if shards else {})}
+        self.stopping = asyncio.Event()
         self.fflogs_token = None
         self.session = session
-        self.refresh_token()
-        self.refresh_points()
+        self.budget = PointBudget()
 
         self.batch_size = batch_size
-        self.mongo_client = MongoClient(utils.MONGO_URI)
-        self.db = self.mongo_client[utils.DATABASE]
-        self.raids = self.db[utils.ENDGAME_METADATA].find_one({"raids": {"$exists": True}})['raids']
+        # How many characters are packed in a single graphql document
+        self.batch_width = batch_width
+        self.metadata = metadata.get()
 
         self.err_lock, self.lock = asyncio.Lock(), asyncio.Lock()
-        self.mongo_operations = []
+        # Writes not flushed yet, a restarted worker flushes them first
+        self.journal = open_journal(journal_dir, f'fflogs-{mode}-{shard or 0}')
+        self.writer = BulkWriter(AsyncIOMotorClient(utils.MONGO_URI)[utils.DATABASE][utils.CHARACTER_COLLECTION],
+                                 flush_size=flush_size, flush_interval=flush_interval, journal=self.journal)
+        # Only current_tier brings rankings, their histograms are updated from every batch
+        self.stats_writer = BulkWriter(self.writer.collection.database[utils.STATS_COLLECTION],
+                                       flush_size=flush_size, flush_interval=flush_interval, journal=self.journal)
+        self.rollups = stats.Rollups(self.writer.collection, self.stats_writer, stats.ranking_contribution,
+                                     stats.RANKING_FIELDS) if rollups and mode == 'current_tier' else None
+
+        self.metrics_port = metrics_port
+        self.change_detection = change_detection
+        self.change_log = change_log
+        metrics.QUEUE_DEPTH.set_function(self.writer.queue.qsize, 'fflogs_writes')
+        metrics.FFLOGS_POINTS.set_function(lambda: self.budget.stats()['points_remaining'] or 0)
 
         self.mode = mode
         if mode == 'simple':
-            self.query = fflogs_utils.fflogs_basic_query
+            self.fields = fflogs_utils.basic_fields
         elif mode == 'current_tier':
-            self.query = fflogs_utils.fflogs_current_tier
+            self.fields = fflogs_utils.current_tier_fields
         elif mode == 'old_fights':
-            self.tiers = ' '.join([f'e_{x}' for x in kwargs['fights_id']])
-            self.query = fflogs_utils.fflogs_current_tier
-
-    def refresh_token(self):
-        tmp = fflogs_utils.get_fflogs_token()
+            # Every zone of the raids metadata unless told otherwise, ids are kept as strings like in the metadata
+            self.explicit_zones = 'zones' in kwargs
+            self.zones = [str(_) for _ in kwargs.get('zones', self.metadata.zones.keys())]
+            self.zones_per_query = zones_per_query
+            self.fields = fflogs_utils.old_tiers_fields
+
+    async def refresh_token(self):
+        tmp = await fflogs_utils.aio_get_fflogs_token(self.session)
         self.fflogs_token = tmp['access_token']
-        self.time_to_new_token = datetime.now() + timedelta(seconds=tmp['expires_in'])
+        # Renewed a bit before it expires so no query is sent with a stale token
+        self.time_to_new_token = datetime.now() + timedelta(seconds=tmp['expires_in']) - TOKEN_MARGIN
+
+    async def refresh_points(self):
+        res = await self.aio_fflogs_query(fflogs_utils.points_info_query)
+        self.budget.update(res['data']['rateLimitData'])
+
+    def stop(self):
+        self.stopping.set()
 
-    def refresh_points(self):
-        res = self.fflogs_query(fflogs_utils.points_info_query)
-        res = res['data']['rateLimitData']
-        self.token_points = res['limitPerHour']
-        self.token_points_left = self.token_points - res['pointsSpentThisHour']
-        self.time_til_points = datetime.now() + timedelta(seconds=res['pointsResetIn'])
+    async def refresh_metadata(self):
+        loaded = await fresh_metadata(self.metadata, self.writer.collection.database)
+        if loaded.version != self.metadata.version:
+            self.metadata = loaded
+            if self.mode == 'old_fights' and not self.explicit_zones:
+                # A new raid gets backfilled too
+                self.zones = [str(_) for _ in loaded.zones.keys()]
 
     async def scrap(self):
         # Should the API tell clients to stop when there's no information
         # to request from fflogs?
         # Check if there's a way to have a clean logic on query and responses execution
-        while True:
-            if self.time_to_new_token > datetime.now():
-                self.refresh_token()
-
-            while self.wait_more_points:
-                if self.time_til_points > datetime.now():
-                    self.wait_more_points = False
-                    self.refresh_points()
-
-            response = requests.get(fflogs_index_api.format(self.batch_size), verify=False)
-            data = response.json()
-            filters_to_apply = []
-
-            for fflogs_id in data['fflogs_id']:
-                filters_to_apply.append(f'id: {fflogs_id}')
-            for character in data['character_data']:
+        try:
+            if self.metrics_port:
+                await metrics.start_server(self.metrics_port)
+            self.writer.start()
+            self.stats_writer.start()
+            await self.refresh_token()
+            await self.refresh_points()
+            while not self.stopping.is_set():
+                try:
+                    await self.refresh_metadata()
+                    await self.scrap_batch()
+                except Exception:
+                    if self.writer.error or self.stats_writer.error:
+                        # Mongo is gone, everything not written is in the journal for the restarted worker
+                        raise
+                    # A timeout or a bad response only costs the batch, it's handed out again once the leases run out
+                    print(traceback.format_exc(), file=sys.stderr)
+                    await idle(self.stopping)
+
+        except Exception:
+            print(traceback.format_exc(), file=sys.stderr)
+        finally:
+            await self.writer.close()
+            await self.stats_writer.close()
+            await self.session.close()
+            self.journal.close()
+
+    async def scrap_batch(self):
+        index_url = fflogs_index_api.format(self.batch_size)
+        async with self.session.get(index_url, params=self.index_params) as response:
+            data = await response.json()
+        if not data['fflogs_id'] and not data['character_data']:
+            await idle(self.stopping)
+            return
+        characters = []
+        for character in data['fflogs_id'] + data['character_data']:
+            if 'fflogs_id' in character:
+                chara_filter = f'id: {character["fflogs_id"]}'
+            else:
                 chara_filter = f'name: "{character["name"]}" serverSlug: "{character["server"]}" ' + \
                                f'serverRegion: "{character["region"]}"'
-                filters_to_apply.append(chara_filter)
+            characters += self.character_requests(chara_filter, character)
+
+        batches = list(utils.split(characters, self.batch_width))
+        tasks = [asyncio.create_task(self.paced_query(batch)) for batch in batches]
+        scrapped = []
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
+        # The batches that came back are written before any error is raised
+        errors = [_ for _ in responses if isinstance(_, Exception) and not isinstance(_, Stopped)]
+        for batch, response in zip(batches, responses):
+            if isinstance(response, Exception):
+                # Batches never sent because of a stop are handed out again once their leases run out
+                continue
+            if 'status' in response.keys() and response['status'] == 429:
+                metrics.RESPONSES.inc('fflogs', 429)
+                self.budget.exhausted()
+                continue
+            metrics.RESPONSES.inc('fflogs', 200)
+            for character, (result, error) in zip(batch, fflogs_utils.split_batched_response(response, len(batch))):
+                if error:
+                    # Left untouched so the API hands it out again
+                    print(f'FFlogs error for {character["key"]}: {error}', file=sys.stderr)
+                elif result is None and self.mode == 'old_fights':
+                    # A backfill of an unknown character is done, there's nothing to backfill
+                    update = {"$set": {'fflogs_backfill_done': True, 'fflogs_found': False}}
+                    await self.writer.put(UpdateOne(character['key'], update))
+                elif result is None:
+                    # Nothing changed as far as fflogs knows, so it backs off like an idle character
+                    update = {"$set": {'scrapped_fflogs_date': datetime.now(), 'fflogs_found': False}}
+                    update = self.schedule_update(update, character, [])
+                    await self.writer.put(UpdateOne(character['key'], update))
+                elif self.mode == 'old_fights':
+                    await self.writer.put(self.backfill_update(character, result))
+                else:
+                    # fflogs' lodestoneID isn't always the claimed character's, 0 for the unlinked ones
+                    result = {**self.clean_mode_response(result), '_id': character['key']['_id']}
+                    operation, changed = self.character_update(character, result)
+                    await self.writer.put(operation)
+                    scrapped.append((result, changed))
+        if self.rollups:
+            await self.rollups.update(scrapped)
+        self.journal.commit()
+        if errors:
+            raise errors[0]
+
+    def character_requests(self, chara_filter: str, character: dict) -> list:
+        """
+            One request per character, but in old_fights mode the zones not backfilled yet are
+            split in chunks of zones_per_query and every chunk is its own request.
+        """
+        # key is how the document is found again if fflogs doesn't return the lodestone id
+        request = {'filter': chara_filter, 'key': {'_id': character['_id']}, 'by_id': 'fflogs_id' in character,
+                   'fingerprint': character.get('fingerprint'), 'interval': character.get('interval')}
+        if self.mode != 'old_fights':
+            return [request]
+        zones_done = set(str(_) for _ in character['zones_done'])
+        chunks = list(utils.split([_ for _ in self.zones if _ not in zones_done], self.zones_per_query))
+        if not chunks:
+            # Nothing left, only the flag is missing
+            return [{**request, 'zones': []}]
+        # The chunks of a character share the counter, the last one to finish marks the backfill as done
+        pending = {'chunks': len(chunks)}
+        return [{**request, 'zones': chunk, 'pending': pending} for chunk in chunks]
+
+    def character_update(self, character: dict, result: dict) -> tuple:
+        """The UpdateOne of a character and the fields that changed, None when change detection is off"""
+        if not self.change_detection:
+            return UpdateOne(character['key'], self.schedule_update({"$set": dict(result)}, character, None)), None
+        update, changed = change_detection.minimal_update(result, character['fingerprint'],
+                                                          change_detection.FFLOGS_FIELDS,
+                                                          change_detection.fflogs_fingerprint_field(self.mode))
+        if self.change_log and character['fingerprint'] is not None and changed:
+            change_detection.add_change_log(update, 'fflogs_changes',
+                                            {'date': result['scrapped_fflogs_date'], 'fields': changed})
+        # Only the claimed document is written, an upsert on another id would leave the claim leased forever
+        return UpdateOne(character['key'], self.schedule_update(update, character, changed)), changed
 
-            tasks = []
-            if self.mode == 'simple':
-                tasks = [asyncio.create_task(self.aio_fflogs_query(self.query.format(_)))
-                         for _ in filters_to_apply]
-                for response in await asyncio.gather(*tasks):
-                    if 'status' in response.keys() and response['status'] == 429:
-                        self.wait_more_points = True
-                    else:
-                        response = self.clean_success_response(response)
-                        update = UpdateOne({"_id": response["_id"]}, {"$set": response}, upsert=True)
-                        self.mongo_operations.append(update)
+    @staticmethod
+    def schedule_update(update: dict, character: dict, changed) -> dict:
+        """Sets when fflogs is asked again, new kills bring the lodestone scrape forward as well"""
+        now = datetime.now()
+        interval = scheduling.next_interval(character['interval'], changed, True, True)
+        update["$set"].update({'fflogs_next': now + interval, 'fflogs_interval': interval.total_seconds()})
+        if character['fingerprint'] is not None and changed and 'rankings' in changed:
+            update["$min"] = {'lodestone_next': now}
+        return update
+
+    def backfill_update(self, character: dict, result: dict) -> UpdateOne:
+        result = self.clean_success_response(result)
+        now = datetime.now()
+        update = {"$set": {'fflogs_backfill_date': now}}
+        if character['zones']:
+            update["$set"].update({f'zone_rankings.{zone}': self.clean_zone_rankings(result.get(f'z{zone}'))
+                                   for zone in character['zones']})
+            update["$addToSet"] = {'zone_rankings_done': {"$each": character['zones']}}
+            character['pending']['chunks'] -= 1
+        if not character['zones'] or character['pending']['chunks'] == 0:
+            update["$set"]['fflogs_backfill_done'] = True
+        if 'fflogs_id' in result:
+            update["$set"]['fflogs_id'] = result['fflogs_id']
+        # The claim gave us the lodestone id already, fflogs may not know it for every character
+        return UpdateOne(character['key'], update)
+
+    @staticmethod
+    def clean_zone_rankings(zone_rankings: dict) -> dict:
+        zone_rankings = zone_rankings or {}
+        return {
+            'difficulty': zone_rankings.get('difficulty'),
+            'zone': zone_rankings.get('zone'),
+            'rankings': [
+                {
+                    str(boss['encounter']['id']): boss['encounter']['name'],
+                    'best_percent': boss['rankPercent'],
+                    'median_percent': boss['medianPercent'],
+                    'total_kills': boss['totalKills'],
+                    'best_job': boss['spec']
+                } for boss in zone_rankings.get('rankings') or []
+            ]
+        }
+
+    async def paced_query(self, batch: list) -> dict:
+        """Waits for the point budget, then sends the batch and learns what it cost"""
+        # Queries cost roughly the same for a given mode, width and amount of zones
+        query_type = f'{self.mode}:{len(batch)}:{sum(len(_.get("zones", [])) for _ in batch)}'
+        await self.budget.acquire(query_type, self.stopping)
+        if self.time_to_new_token < datetime.now():
+            async with self.lock:
+                if self.time_to_new_token < datetime.now():
+                    await self.refresh_token()
+        with metrics.STAGE_SECONDS.time('graphql'):
+            response = await self.aio_fflogs_query(self.batched_query(batch))
+        rate_limit_data = (response.get('data') or {}).get('rateLimitData')
+        if rate_limit_data:
+            self.budget.update(rate_limit_data, query_type)
+        return response
 
+    def batched_query(self, batch: list) -> str:
+        selections = []
+        for character in batch:
+            extra_fields = '' if character['by_id'] else 'canonicalID hidden'
+            if self.mode == 'simple':
+                fields = self.fields
             elif self.mode == 'current_tier':
-                for character_filter in filters_to_apply:
-                    extra_fields = '' if 'id' in character_filter else 'canonicalID hidden'
-                    query = self.query.format(character_filter, extra_fields)
-                    task = asyncio.create_task(self.aio_fflogs_query(query))
-                    tasks.append(task)
-
-                for response in await asyncio.gather(*tasks):
-                    if 'status' in response.keys() and response['status'] == 429:
-                        self.wait_more_points = True
-                    else:
-                        response = self.clean_success_response(response)
-                        response = {
-                            '_id': response['_id'], 'scrapped_fflogs_date': response['scrapped_fflogs_date'],
-                            'difficulty': response['zoneRankings']['difficulty'],
-                            'zone': response['zoneRankings']['zone'],
-                            'rankings': [
-                                {
-                                    str(boss['encounter']['id']): boss['encounter']['name'],
-                                    'best_percent': boss['rankPercent'],
-                                    'median_percent': boss['medianPercent'],
-                                    'total_kills': boss['totalKills'],
-                                    'best_job': boss['spec']
-                                } for boss in response['zoneRankings']['rankings']
-                            ]
-                        }
-                        update = UpdateOne({"_id": response["_id"]}, {"$set": response}, upsert=True)
-                        self.mongo_operations.append(update)
-
-            elif self.mode == 'old_fights':
-                for character_filter in filters_to_apply:
-                    extra_fields = '' if 'id' in character_filter else 'canonicalID hidden'
-                    query = self.query.format(character_filter, extra_fields, self.tiers)
-                    task = asyncio.create_task(self.aio_fflogs_query(query))
-                    tasks.append(task)
-
-            if self.mongo_operations:
-                self.db[utils.CHARACTER_COLLECTION].bulk_write(self.mongo_operations)
-                self.mongo_operations = []
+                fields = self.fields.format(extra_fields)
+            else:
+                zones = ' '.join(f'z{zone}: zoneRankings(zoneID: {zone})' for zone in character['zones'])
+                fields = self.fields.format(extra_fields, zones)
+            selections.append((character['filter'], fields))
+        return fflogs_utils.batched_character_query(selections)
+
+    def clean_mode_response(self, response: dict) -> dict:
+        response = self.clean_success_response(response)
+        if self.mode == 'current_tier':
+            response = {
+                '_id': response['_id'], 'scrapped_fflogs_date': response['scrapped_fflogs_date'],
+                **self.clean_zone_rankings(response['zoneRankings'])
+            }
+        return response
 
     @staticmethod
     def clean_success_response(response):
@@ -260,19 +756,41 @@ class FFlogsScraper:
             response_data = await response.json()
             return response_data
 
-    def fflogs_query(self, query: str) -> dict:
-        headers = {'Content-Type': "application/json", 'Authorization': f'Bearer {self.fflogs_token}'}
-        payload = {'query': query}
-        fflogs_res = requests.post(fflogs_utils.API_URL, headers=headers, json=payload)
-        return fflogs_res.json()
 
+SCRAPERS = {'lodestone': LodestoneScraper, 'fflogs': FFlogsScraper, 'freecompany': FreeCompanyScraper}
 
-async def main():
-    async with aiohttp.ClientSession() as session:
-        # scraper = LodestoneScraper(session=session, batch_size=10, delay=3)
-        # scraper = FFlogsScraper(session, batch_size=3, mode='current_tier')
-        # await scraper.scrap()
-        pass
+
+def scraper_options(scraper_class, options: dict) -> dict:
+    """The options a scraper takes, the ones meant for the others running next to it are left out"""
+    parameters = inspect.signature(scraper_class).parameters
+    if any(_.kind == inspect.Parameter.VAR_KEYWORD for _ in parameters.values()):
+        return options
+    return {key: value for key, value in options.items() if key in parameters}
+
+
+async def main(kind: str = 'lodestone', **options):
+    """
+        Runs scrapers until they're stopped, fleet.py runs one of these per worker process.
+        kind can join several with +, lodestone+freecompany runs both in one process sharing the lodestone limiter.
+        SIGTERM finishes the batch in hand and flushes the pending writes before returning.
+    """
+    scrapers = [SCRAPERS[_](aiohttp.ClientSession(), **scraper_options(SCRAPERS[_], options)) for _ in kind.split('+')]
+
+    def stop():
+        for scraper in scrapers:
+            scraper.stop()
+
+    async def run(scraper):
+        try:
+            await scraper.scrap()
+        finally:
+            # One scraper ending ends the worker, fleet.py restarts it whole
+            stop()
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+    for result in await asyncio.gather(*[run(_) for _ in scrapers], return_exceptions=True):
+        if isinstance(result, Exception):
+            raise result
 
 # a quick test
 if __name__ == '__main__':
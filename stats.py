@@ -0,0 +1,128 @@
+import os
+import utils
+
+from pymongo import MongoClient, UpdateOne
+
+# Level that counts as capped, jobs with their own cap are listed apart
+LEVEL_CAP = int(os.getenv("LEVEL_CAP", 100))
+JOB_LEVEL_CAPS = {'Blue Mage': int(os.getenv("BLUE_MAGE_LEVEL_CAP", 80))}
+# Job rollups are kept for every character, and per server, datacenter and region
+LOCATION_FIELDS = ('server', 'datacenter', 'region')
+JOB_FIELDS = ('jobs',) + LOCATION_FIELDS
+RANKING_FIELDS = ('rankings',)
+# Width of the ranking percentile buckets
+PERCENT_BUCKET = 5
+# Keys of a cleaned fflogs ranking, the one left is the encounter id
+RANKING_KEYS = ('best_percent', 'median_percent', 'total_kills', 'best_job')
+
+
+def job_contribution(character: dict) -> tuple:
+    """
+        Counters a character adds to the job rollups, stats document id -> {field: count}.
+        Levels are counted per job and level, jobs not unlocked yet (level 0) are left out.
+    """
+    if not character or not character.get('exists') or not character.get('jobs'):
+        return {}, {}
+    counters = {}
+    for scope, key in [('all', 'all')] + [(_, character[_]) for _ in LOCATION_FIELDS if character.get(_)]:
+        counter = counters[f'jobs:{scope}:{key}'] = {'characters': 1}
+        for job, level in character['jobs'].items():
+            if level:
+                counter[f'levels.{job}.{level}'] = 1
+                if level >= JOB_LEVEL_CAPS.get(job, LEVEL_CAP):
+                    counter[f'capped.{job}'] = 1
+    return counters, {}
+
+
+def ranking_contribution(character: dict) -> tuple:
+    """Counters a character adds to the percentile histograms of the encounters it killed, plus their names"""
+    counters, labels = {}, {}
+    for ranking in (character or {}).get('rankings') or []:
+        if not ranking.get('total_kills') or ranking.get('best_percent') is None:
+            continue
+        encounter = next(_ for _ in ranking if _ not in RANKING_KEYS)
+        bucket = min(int(ranking['best_percent'] // PERCENT_BUCKET) * PERCENT_BUCKET, 100 - PERCENT_BUCKET)
+        counters[f'rankings:{encounter}'] = {'characters': 1, f'best_percent.{bucket}': 1,
+                                             f'best_job.{ranking["best_job"]}': 1}
+        labels[f'rankings:{encounter}'] = {'name': ranking[encounter]}
+    return counters, labels
+
+
+def merge(deltas: dict, counters: dict, sign: int):
+    for _id, counter in counters.items():
+        delta = deltas.setdefault(_id, {})
+        for field, value in counter.items():
+            delta[field] = delta.get(field, 0) + sign * value
+
+
+class Rollups:
+    """
+        Keeps the stats collection up to date from the write set of every scrape batch.
+        Only the characters whose rolled up fields changed are looked at: their stored document (not written yet)
+        is what's counted now, its counters are taken out and the new ones added, all as a single $inc per
+        stats document. rebuild() starts the counters from a full scan.
+        The writer should share the journal of the character writes (see journal.py), a crash between the two
+        flushes then replays whichever one didn't make it and the counters keep matching the characters.
+    """
+    def __init__(self, characters, writer, contribution, fields: tuple, old_filter: dict = None):
+        self.characters = characters
+        self.writer = writer
+        self.contribution = contribution
+        self.fields = fields
+        self.old_filter = old_filter or {}
+
+    async def update(self, scrapped: list):
+        """
+            scrapped holds the (payload, changed fields) of a batch, changed is None when it's not known.
+            A character that stopped or started existing must have 'exists' among its changed fields,
+            its fingerprinted fields may well be the same as before it went missing.
+        """
+        fields = set(self.fields) | {'exists'}
+        touched = [payload for payload, changed in scrapped if changed is None or set(changed) & fields]
+        if not touched:
+            return
+        cursor = self.characters.find({"_id": {"$in": [_['_id'] for _ in touched]}, **self.old_filter},
+                                      list(self.fields) + ['exists'])
+        old = {item['_id']: item async for item in cursor}
+        deltas, labels = {}, {}
+        for payload in touched:
+            merge(deltas, self.contribution(old.get(payload['_id']))[0], -1)
+            counters, payload_labels = self.contribution(payload)
+            merge(deltas, counters, 1)
+            labels.update(payload_labels)
+        for operation in operations(deltas, labels):
+            await self.writer.put(operation)
+
+
+def operations(deltas: dict, labels: dict) -> list:
+    result = []
+    for _id, delta in deltas.items():
+        update = {}
+        delta = {field: value for field, value in delta.items() if value}
+        if delta:
+            update["$inc"] = delta
+        if _id in labels:
+            update["$set"] = labels[_id]
+        if update:
+            result.append(UpdateOne({"_id": _id}, update, upsert=True))
+    return result
+
+
+def rebuild(chunk_size: int = 10_000) -> int:
+    """
+        Recomputes every rollup with a full scan of the characters, run it once before the scrapers keep
+        the counters up to date, with the scrapers stopped. Returns the amount of stats documents.
+    """
+    db = MongoClient(utils.MONGO_URI)[utils.DATABASE]
+    deltas, labels = {}, {}
+    cursor = db[utils.CHARACTER_COLLECTION].find({"$or": [{"exists": True}, {"rankings": {"$exists": True}}]},
+                                                 list(JOB_FIELDS + RANKING_FIELDS) + ['exists'], batch_size=chunk_size)
+    for character in cursor:
+        for contribution in (job_contribution, ranking_contribution):
+            counters, character_labels = contribution(character)
+            merge(deltas, counters, 1)
+            labels.update(character_labels)
+    db[utils.STATS_COLLECTION].delete_many({})
+    for chunk in utils.split(operations(deltas, labels), chunk_size):
+        db[utils.STATS_COLLECTION].bulk_write(chunk, ordered=False)
+    return len(deltas)
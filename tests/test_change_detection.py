@@ -0,0 +1,52 @@
+import change_detection
+
+from change_detection import FFLOGS_FIELDS, fflogs_fingerprint_field, minimal_update, mode_fingerprint
+
+SIMPLE = {'_id': 1, 'scrapped_fflogs_date': 1, 'name': 'Chara', 'fflogs_id': 10, 'hidden': False}
+CURRENT_TIER = {'_id': 1, 'scrapped_fflogs_date': 2, 'difficulty': 101, 'zone': 62, 'rankings': [{'best_percent': 90}]}
+
+
+def apply(document: dict, update: dict):
+    """Just enough of mongo's $set/$unset for the updates of minimal_update, dotted paths one level deep"""
+    for key, value in update.get("$set", {}).items():
+        if '.' in key:
+            parent, child = key.split('.', 1)
+            document.setdefault(parent, {})[child] = value
+        else:
+            document[key] = value
+    for key in update.get("$unset", {}):
+        document.pop(key, None)
+
+
+def scrape(document: dict, payload: dict, mode: str) -> tuple:
+    """What the API hands out and the scraper writes back for one fflogs scrape"""
+    old_fingerprint = mode_fingerprint(document.get('fflogs_fp'), mode)
+    update, changed = minimal_update(payload, old_fingerprint, FFLOGS_FIELDS, fflogs_fingerprint_field(mode))
+    apply(document, update)
+    return update, changed
+
+
+def test_fflogs_mode_switch_keeps_the_other_mode_fields():
+    document = {'_id': 1}
+    scrape(document, SIMPLE, 'simple')
+    update, _ = scrape(document, CURRENT_TIER, 'current_tier')
+    assert "$unset" not in update
+    update, changed = scrape(document, SIMPLE, 'simple')
+    assert "$unset" not in update
+    assert changed == []
+    for field in ('name', 'fflogs_id', 'hidden', 'difficulty', 'zone', 'rankings'):
+        assert field in document
+
+
+def test_fflogs_field_gone_within_a_mode_is_unset():
+    document = {'_id': 1}
+    scrape(document, {**CURRENT_TIER, 'rankings': []}, 'current_tier')
+    update, changed = scrape(document, {_: CURRENT_TIER[_] for _ in CURRENT_TIER if _ != 'rankings'}, 'current_tier')
+    assert update["$unset"] == {'rankings': ''}
+    assert changed == ['rankings']
+
+
+def test_flat_fingerprint_counts_as_no_fingerprint():
+    flat = change_detection.fingerprint(SIMPLE, FFLOGS_FIELDS)
+    assert mode_fingerprint(flat, 'current_tier') is None
+    assert mode_fingerprint({'simple': flat}, 'simple') == flat
@@ -0,0 +1,29 @@
+import os
+import pytest
+import sys
+
+from lodestone_parser import PARSERS, CharacterParser, world_tables
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from character_page import WORLDS, render_character_page  # noqa: E402
+
+REGIONS = {'1': {'name': 'Europe', 'slug': 'EU', 'servers': {
+    str(i): {'name': world, 'slug': world.lower(), 'datacenter': datacenter}
+    for i, (world, datacenter) in enumerate(WORLDS)}}}
+
+
+def test_parser_without_parse_fails_when_created():
+    class Incomplete(CharacterParser):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete({}, {})
+
+
+def test_backends_agree():
+    worlds, regions = world_tables(REGIONS)
+    parsers = [backend(worlds, regions) for backend in PARSERS.values()]
+    for character_id in (1, 2, 3):
+        page = render_character_page(character_id)
+        assert parsers[0].parse(page) == parsers[1].parse(page)
+
@@ -0,0 +1,70 @@
+import aiohttp
+import asyncio
+import os
+import socket
+import sys
+import time
+
+from rate_limiter import AdaptiveRateLimiter, retry_after_seconds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from fake_servers import FakeLodestone, serve  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def drive(limiter: AdaptiveRateLimiter, url: str, seconds: float, workers: int = 20) -> list:
+    """Requests through the limiter for a while, returns (permit time, status, response time) of every request"""
+    log = []
+    deadline = time.monotonic() + seconds
+
+    async def worker(session):
+        while time.monotonic() < deadline:
+            async with limiter:
+                permitted = time.monotonic()
+                async with session.get(url) as response:
+                    limiter.record(response.status, response.headers.get('Retry-After'))
+                    log.append((permitted, response.status, time.monotonic()))
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[worker(session) for _ in range(workers)])
+    return log
+
+
+def test_limiter_backs_off_honours_retry_after_and_recovers():
+    async def scenario():
+        fake = FakeLodestone(latency=0.01, jitter=0, not_found=0, throttle_rate=10, retry_after=1)
+        port = free_port()
+        runner = await serve(fake.app(), port)
+        url = f'http://127.0.0.1:{port}/lodestone/character/1/'
+        limiter = AdaptiveRateLimiter(rate=40, max_rate=60)
+        try:
+            throttled = await drive(limiter, url, 3)
+            backed_off = limiter.rate
+            # Lodestone stops throttling, the rate has to climb back
+            fake.throttle_rate = None
+            await drive(limiter, url, 3)
+        finally:
+            await runner.cleanup()
+        return throttled, backed_off, limiter.rate
+
+    throttled, backed_off, recovered = asyncio.run(scenario())
+    assert any(status == 429 for _, status, _ in throttled)
+    assert backed_off < 40
+
+    # Nothing is let through for Retry-After seconds after the first 429 is recorded
+    first_429 = min(answered for _, status, answered in throttled if status == 429)
+    assert not [permitted for permitted, _, _ in throttled if first_429 < permitted < first_429 + 0.95]
+
+    assert recovered > backed_off
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('3') == 3
+    assert retry_after_seconds('-1') == 0
+    assert retry_after_seconds(None) == 0
+    assert retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
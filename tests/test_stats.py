@@ -0,0 +1,70 @@
+import asyncio
+import stats
+
+
+class FakeCursor:
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCharacters:
+    """find() of the characters collection for the filters Rollups sends: _id $in plus equality fields"""
+    def __init__(self, documents):
+        self.documents = {_['_id']: _ for _ in documents}
+
+    def find(self, query: dict, projection: list):
+        ids = query['_id']['$in']
+        equal = {key: value for key, value in query.items() if key != '_id'}
+        return FakeCursor([self.documents[_] for _ in ids if _ in self.documents and
+                           all(self.documents[_].get(key) == value for key, value in equal.items())])
+
+
+class FakeWriter:
+    def __init__(self):
+        self.operations = []
+
+    async def put(self, operation):
+        self.operations.append(operation)
+
+
+def rollups_of(documents: list) -> tuple:
+    writer = FakeWriter()
+    return stats.Rollups(FakeCharacters(documents), writer, stats.job_contribution, stats.JOB_FIELDS,
+                         {"exists": True}), writer
+
+
+def increments(writer: FakeWriter) -> dict:
+    return {operation._filter['_id']: operation._doc.get("$inc", {}) for operation in writer.operations}
+
+
+CHARACTER = {'_id': 1, 'exists': True, 'jobs': {'Paladin': 100, 'Sage': 0}, 'server': 'Cerberus',
+             'datacenter': 'Chaos', 'region': 'EU'}
+
+
+def test_character_back_from_404_is_counted_again():
+    rollups, writer = rollups_of([{**CHARACTER, 'exists': False}])
+    asyncio.run(rollups.update([(CHARACTER, ['exists'])]))
+    counters = increments(writer)
+    assert counters['jobs:all:all'] == {'characters': 1, 'levels.Paladin.100': 1, 'capped.Paladin': 1}
+    assert counters['jobs:server:Cerberus']['characters'] == 1
+
+
+def test_unchanged_character_is_not_counted_twice():
+    rollups, writer = rollups_of([CHARACTER])
+    asyncio.run(rollups.update([(CHARACTER, [])]))
+    assert writer.operations == []
+
+
+def test_character_gone_is_counted_out():
+    rollups, writer = rollups_of([CHARACTER])
+    asyncio.run(rollups.update([({'_id': 1, 'exists': False}, None)]))
+    assert increments(writer)['jobs:all:all'] == {'characters': -1, 'levels.Paladin.100': -1, 'capped.Paladin': -1}
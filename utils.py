@@ -1,5 +1,13 @@
-from pymongo import MongoClient
+import aiohttp
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from fflogs_utils import create_metadata_collections
+from datetime import datetime, timedelta
+from rate_limiter import AdaptiveRateLimiter
+import scheduling
 import os
 
 # MongoDB things
@@ -8,14 +16,171 @@ DATABASE = os.getenv("MONGO_DB")
 CHARACTER_COLLECTION = os.getenv("MONGO_CHARACTER")
 ENDGAME_COLLECTION = os.getenv("MONGO_ENDGAME")
 ENDGAME_METADATA = os.getenv("MONGO_ENDGAME_METADA")
+FREE_COMPANY_COLLECTION = os.getenv("MONGO_FREECOMPANY", "free_companies")
+STATS_COLLECTION = os.getenv("MONGO_STATS", "stats")
 
+# Work queue things, every document carries the date it's due to be scrapped again,
+# claiming a document moves that date forward by the lease time
+EPOCH = datetime(1970, 1, 1)
+LEASE_TIME = timedelta(minutes=int(os.getenv("LEASE_MINUTES", 5)))
 
-def create_empty_documents(top_index: int = 20_000_001) -> None:
+# Scrapers write through mongo_writer.BulkWriter, these are its defaults
+WRITE_FLUSH_SIZE = int(os.getenv("WRITE_FLUSH_SIZE", 500))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", 2))
+
+# Worker processes used to parse lodestone pages, 0 parses on the event loop
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 0))
+
+# Directory where the lodestone scraper keeps the raw pages, see page_archive.py. Not set means no archive
+PAGE_ARCHIVE_DIR = os.getenv("PAGE_ARCHIVE_DIR")
+
+# Directory of the scrapers' sqlite journals, see journal.py. Not set keeps the journal in memory
+JOURNAL_DIR = os.getenv("SCRAPE_JOURNAL_DIR")
+# Failed scrapes of an id before the scraper lets it go, the queue hands it out again once its lease expires
+MAX_ATTEMPTS = int(os.getenv("SCRAPE_MAX_ATTEMPTS", 5))
+
+# Endpoints, they can be pointed at the stand-ins in benchmarks/fake_servers.py
+LODESTONE_URL = os.getenv("LODESTONE_URL", "https://eu.finalfantasyxiv.com")
+LODESTONE_CHARACTER_URL = LODESTONE_URL + '/lodestone/character/{}/'
+LODESTONE_FC_MEMBERS_URL = LODESTONE_URL + '/lodestone/freecompany/{}/member/'
+INDEX_API_URL = os.getenv("INDEX_API_URL", "http://127.0.0.1:8000")
+# Metadata document holding the highest live character id found by discover_frontier
+FRONTIER_ID = 'lodestone_frontier'
+# The API probes lodestone again once the queue ran out at a frontier older than this
+FRONTIER_MAX_AGE = timedelta(hours=float(os.getenv("FRONTIER_MAX_AGE_HOURS", 24)))
+
+
+def placeholder_documents(start: int, stop: int):
+    for i in range(start, stop):
+        yield {"_id": i, "scrapped_lodestone_date": None, "scrapped_fflogs_date": None, "lodestone_next": EPOCH}
+
+
+def create_empty_documents(top_index: int = 20_000_001, start: int = 1, chunk_size: int = 10_000,
+                           workers: int = 4, progress_every: int = 1_000_000) -> None:
+    """
+        Inserts the placeholder documents of [start, top_index) in unordered chunks from a few threads.
+        Documents are generated as they are inserted, memory stays at about workers * 2 chunks.
+    """
+    mongo_client = MongoClient(MONGO_URI)
+    collection = mongo_client[DATABASE][CHARACTER_COLLECTION]
+    documents = placeholder_documents(start, top_index)
+
+    def insert(chunk):
+        try:
+            collection.insert_many(chunk, ordered=False)
+        except BulkWriteError as e:
+            # Already existing ids are fine, seeding can be run again over the same range
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+            return e.details['nInserted']
+        return len(chunk)
+
+    inserted, reported = 0, 0
+    with ThreadPoolExecutor(workers) as executor:
+        pending = set()
+        while True:
+            chunk = list(islice(documents, chunk_size))
+            if chunk:
+                pending.add(executor.submit(insert, chunk))
+            if len(pending) >= workers * 2 or (not chunk and pending):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                inserted += sum(future.result() for future in done)
+                if inserted - reported >= progress_every:
+                    print(f'{inserted} documents inserted, up to id ~{start + inserted - 1}')
+                    reported = inserted
+            if not chunk and not pending:
+                break
+    print(f'{inserted} documents inserted')
+
+
+async def is_live(session, limiter, character_id: int, window: int, attempts: int = 5) -> bool:
+    """Deleted characters leave holes, so a whole window of ids is probed"""
+    async def probe(i):
+        for attempt in range(attempts):
+            # The permit and the response are let go before waiting for the retry
+            async with limiter, session.get(LODESTONE_CHARACTER_URL.format(i)) as response:
+                limiter.record(response.status, response.headers.get('Retry-After'))
+                if response.status != 429:
+                    return response.status == 200
+            await asyncio.sleep(min(2 ** attempt, 30))
+        # A guess either way would put the frontier in the wrong place
+        raise RuntimeError(f'Lodestone kept answering 429 for character {i}')
+    return any(await asyncio.gather(*[probe(i) for i in range(character_id, character_id + window)]))
+
+
+async def discover_frontier(start: int = None, window: int = 20, step: int = 1024) -> int:
+    """
+        Finds the highest live character id with galloping probes: the step doubles while the window
+        after it has live characters, then a binary search narrows down the last live window.
+        The result is stored in the metadata collection so the API doesn't create ids past it.
+    """
+    db = MongoClient(MONGO_URI)[DATABASE]
+    if start is None:
+        last_seen = db[CHARACTER_COLLECTION].find_one({"exists": True}, ['_id'], sort=[("_id", -1)])
+        start = last_seen['_id'] if last_seen else 1
+    limiter = AdaptiveRateLimiter()
+    async with aiohttp.ClientSession() as session:
+        low = start
+        while await is_live(session, limiter, low + step, window):
+            low += step
+            step *= 2
+        # Live at low, dead at low + step
+        high = low + step
+        while high - low > window:
+            middle = (low + high) // 2
+            if await is_live(session, limiter, middle, window):
+                low = middle
+            else:
+                high = middle
+    frontier = low + window - 1
+    db[ENDGAME_METADATA].update_one({"_id": FRONTIER_ID}, {"$set": {"frontier": frontier, "date": datetime.now()}},
+                                    upsert=True)
+    return frontier
+
+
+def seed_to_frontier() -> None:
+    """Discovers the frontier and creates the placeholders between the highest stored id and it"""
+    db = MongoClient(MONGO_URI)[DATABASE]
+    last = db[CHARACTER_COLLECTION].find_one({}, ['_id'], sort=[("_id", -1)])
+    frontier = asyncio.run(discover_frontier())
+    print(f'lodestone frontier at {frontier}')
+    create_empty_documents(frontier + 1, start=last['_id'] + 1 if last else 1)
+
+
+def create_queue_fields() -> None:
+    """
+        Fills lodestone_next on documents created before the work queue existed, and puts back in the
+        queue the missing characters that left it before they were rescheduled with a backoff
+    """
     mongo_client = MongoClient(MONGO_URI)
     db = mongo_client[DATABASE]
-    indexes = [{"_id": i, "scrapped_lodestone_date": None,
-                "scrapped_fflogs_date": None} for i in range(1, top_index)]
-    db[CHARACTER_COLLECTION].insert_many(indexes)
+    rescan_ms = scheduling.DEFAULT_INTERVAL.total_seconds() * 1000
+    missing_ms = scheduling.MISSING_BASE_INTERVAL.total_seconds() * 1000
+    # null also matches the documents without the field
+    db[CHARACTER_COLLECTION].update_many({"lodestone_next": None}, [{"$set": {"lodestone_next": {
+        "$cond": [
+            {"$eq": ["$exists", False]},
+            {"$add": ["$$NOW", missing_ms]},
+            {"$ifNull": [{"$add": ["$scrapped_lodestone_date", rescan_ms]}, EPOCH]}
+        ]
+    }}}])
+
+
+def seed_free_companies(chunk_size: int = 10_000) -> int:
+    """
+        Queues the free companies found in the scrapped characters for FreeCompanyScraper,
+        the ones already queued are left as they are. Returns how many were new.
+    """
+    db = MongoClient(MONGO_URI)[DATABASE]
+    cursor = db[CHARACTER_COLLECTION].aggregate([{"$match": {"fc_id": {"$ne": None}}}, {"$group": {"_id": "$fc_id"}}],
+                                                allowDiskUse=True)
+    seeded = 0
+    for chunk in iter(lambda: list(islice(cursor, chunk_size)), []):
+        result = db[FREE_COMPANY_COLLECTION].bulk_write(
+            [UpdateOne({"_id": _['_id']}, {"$setOnInsert": {"fc_next": EPOCH}}, upsert=True) for _ in chunk],
+            ordered=False)
+        seeded += result.upserted_count
+    return seeded
 
 
 def delete_db():